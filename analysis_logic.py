@@ -1,172 +1,582 @@
 import os
-import base64
 import json
 import time
+import asyncio
 import datetime as dt
 import pandas as pd
 import numpy as np
-import google.generativeai as genai
-from googleapiclient.discovery import build
+from google.api_core.exceptions import ResourceExhausted
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy import delete
 
 import models
+from batch_packer import COMPACT_OUTPUT_TOKENS_PER_ITEM, MAX_ITEM_TOKENS, BatchPacker
+from body_compaction import fit_body
+from dedup import NearDuplicateIndex
+from email_record import EmailRecord
+from gemini_prompts import (
+    BATCH_PROMPT, BATCH_PROMPT_VERSION, COMPACT_BATCH_PROMPT, GEMINI_CASCADE, GEMINI_COMPACT_OUTPUT,
+    GEMINI_MODEL_NAME, GEMINI_TRIAGE_MODEL, TRIAGE_ITEM_TOKENS, TRIAGE_OUTPUT_TOKENS_PER_ITEM, TRIAGE_PROMPT,
+    build_batch_prompt, build_triage_prompt, decode_batch_response, estimate_batch_tokens, estimate_triage_tokens,
+)
+from gemini_response import coerce_id, strip_code_fence
+import gmail_quota
+from gemini_limiter import GEMINI_CONCURRENCY, GEMINI_MAX_RETRIES, UsageStats, estimate_tokens
+from gemini_hedge import HedgePolicy
+from gemini_pool import get_gemini_pool
+from gmail_service import get_gmail_service, store_refreshed_token
+from gmail_fetch import (
+    GMAIL_BATCH_SIZE, GMAIL_HORIZON_DAYS, aiter_message_id_pages, build_sync_query,
+    fetch_messages_batched, fetch_threads_batched, list_history_message_ids,
+)
+from blocking_io import run_blocking, run_gemini
+from llm_cache import lookup_extractions, purge_stale_extractions, store_extractions
+from message_cache import get_message_cache
+from subscription_classifier import CLASSIFIER_THRESHOLD, get_classifier, get_example_store
+from template_store import get_template_store
+from triage import TRIAGE_FIELDS, TRIAGE_HEADERS, is_candidate
 
-# --- (Helper functions and BATCH_PROMPT remain the same) ---
-def get_plain_text_from_message(msg_detail):
-    payload = msg_detail.get("payload", {})
-    mime_type = payload.get("mimeType", "")
-    body = payload.get("body", {})
-    parts = payload.get("parts", [])
-
-    if mime_type == "text/plain" and "data" in body:
-        data = body["data"]
-        return base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-
-    text_parts = []
-    def walk_parts(parts_list):
-        for part in parts_list:
-            part_mime = part.get("mimeType", "")
-            part_body = part.get("body", {})
-            sub_parts = part.get("parts", [])
-            if sub_parts:
-                walk_parts(sub_parts)
-            if part_mime == "text/plain" and "data" in part_body:
-                data = part_body["data"]
-                text = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                text_parts.append(text)
-
-    if parts:
-        walk_parts(parts)
-    
-    return "\n".join(text_parts) if text_parts else ""
-
-BATCH_PROMPT = """
-You are an analyzer that extracts 'subscription/recurring payment/newsletter/membership' information from emails.
-A list of multiple emails will be given as input.
-Each email is represented as a single line of JSON, in the format:
-{"id": 1, "subject": "...", "sender": "...", "body": "..."}
-
-Your tasks:
-1) Determine if each email is related to a subscription/recurring payment/newsletter/membership.
-2) Convert only the relevant ones into a JSON object with the format below.
-3) Finally, output only a JSON array (No explanations, no code blocks).
-
-Format:
-[
-  {
-    "id": 1,
-    "is_subscription": true,
-    "service_name": "Service or brand name",
-    "plan_name": "Plan name or null",
-    "price": "Price as a string or null",
-    "currency": "KRW, USD, etc., or null",
-    "billing_cycle": "monthly / yearly / weekly / once / unknown",
-    "start_date": "YYYY-MM-DD format or null",
-    "next_billing_date": "YYYY-MM-DD format or null"
-  },
-  ...
-]
-
-If an email is completely unrelated to subscriptions/recurring payments, exclude it from the array entirely.
-If there are no related emails, output an empty array [].
-"""
-
-def analyze_emails_batch_with_gemini(email_items, gemini_api_key):
+def triage_emails_with_gemini(email_items, gemini_api_key, usage=None):
+    """
+    Returns the set of ids the cheap triage model flags as subscription-related. A failed request
+    or an unreadable answer flags every id, so the full extraction decides instead.
+    Rate-limit errors (429) are raised so the caller can back off and retry.
+    """
+    all_ids = {item["id"] for item in email_items}
+    model = get_gemini_pool().model(gemini_api_key, GEMINI_TRIAGE_MODEL, json_mode=True)
+
+    started = time.perf_counter()
+    try:
+        resp = model.generate_content(build_triage_prompt(email_items))
+        if usage is not None:
+            usage.record("triage", time.perf_counter() - started, resp)
+        flagged = json.loads(strip_code_fence(resp.text))
+    except ResourceExhausted:
+        raise
+    except Exception as e:
+        print(f"Error during Gemini triage, sending the whole batch to extraction: {e}")
+        return all_ids
+    if not isinstance(flagged, list):
+        return all_ids
+    return {_id for _id in map(coerce_id, flagged) if _id in all_ids}
+
+def _batch_model(gemini_api_key, compact):
+    # Compact rows are requested in Gemini's JSON mode
+    return get_gemini_pool().model(gemini_api_key, GEMINI_MODEL_NAME, json_mode=compact)
+
+def analyze_emails_batch_with_gemini(email_items, gemini_api_key, compact=GEMINI_COMPACT_OUTPUT, usage=None):
+    """
+    Sends one batch and returns decode_batch_response's (result, missing); a failed request
+    counts every id as missing. Rate-limit errors (429) are raised so the caller can back off and retry.
+    """
     if not email_items:
-        return {}
-
-    genai.configure(api_key=gemini_api_key)
-    model = genai.GenerativeModel("gemini-2.0-flash-lite") # Using a more robust model
-
-    lines = []
-    for item in email_items:
-        body = item["body"] or ""
-        if len(body) > 4000:
-            body = body[:4000]
-        obj = {
-            "id": item["id"],
-            "subject": item["subject"],
-            "sender": item["sender"],
-            "body": body,
-        }
-        lines.append(json.dumps(obj, ensure_ascii=False))
-
-    joined = "\n".join(lines)
-    prompt = BATCH_PROMPT + "\n\n### Email List\n" + joined
+        return {}, set()
+
+    model = _batch_model(gemini_api_key, compact)
+    prompt = build_batch_prompt(email_items, compact)
 
+    started = time.perf_counter()
     try:
         resp = model.generate_content(prompt)
-        text = resp.text.strip()
-        text = text.strip("`").strip()
-        if text.lower().startswith("json"):
-            text = text[4:].strip()
+        if usage is not None:
+            usage.record("extract", time.perf_counter() - started, resp)
+        text = resp.text
+    except ResourceExhausted:
+        raise
+    except Exception as e:
+        print(f"Error during Gemini batch analysis: {e}")
+        return {}, {item["id"] for item in email_items}
+    return decode_batch_response(text, email_items, compact)
+
+# How many fetched chunks / pending Gemini batches may queue up between stages.
+PIPELINE_QUEUE_SIZE = 4
+_DONE = object()
+# Two-phase fetch: metadata triage before downloading full MIME trees
+GMAIL_TRIAGE = os.getenv("GMAIL_TRIAGE", "1") != "0"
+# Thread mode: list/fetch users.threads and analyze only the newest message of each conversation
+GMAIL_THREAD_MODE = os.getenv("GMAIL_THREAD_MODE", "0") == "1"
+THREAD_TRIAGE_FIELDS = "id,messages(id,threadId,labelIds,internalDate,payload/headers)"
+# Send only one representative per cluster of near-identical emails to Gemini
+GEMINI_DEDUP = os.getenv("GEMINI_DEDUP", "1") != "0"
+# Extract emails matching a confidently learned sender template locally instead of via Gemini
+SENDER_TEMPLATES = os.getenv("SENDER_TEMPLATES", "1") != "0"
+# Skip Gemini for emails the local classifier scores below CLASSIFIER_THRESHOLD (once a model is trained)
+SUBSCRIPTION_CLASSIFIER = os.getenv("SUBSCRIPTION_CLASSIFIER", "1") != "0"
+# Keep Gemini's verdicts as training examples for the local classifier
+CLASSIFIER_COLLECT = os.getenv("CLASSIFIER_COLLECT", "1") != "0"
+
+async def recover_batch(analyze, chunk, recovery, lost_ids):
+    """
+    Sends a batch through `analyze` (returning (result, missing ids)) and re-asks for the emails
+    whose answer was lost: what is left after a partly salvaged response goes out again as one
+    smaller batch, and a batch that comes back with nothing usable is split in half, down to
+    single emails. Counts into `recovery` and adds the ids of emails that stayed unanswered to `lost_ids`.
+    """
+    analysis_map, missing = await analyze(chunk)
+    if not missing:
+        return analysis_map
+    lost = [item for item in chunk if item["id"] in missing]
+    if len(chunk) == 1:
+        recovery["lost"] += 1
+        lost_ids.add(chunk[0]["id"])
+        return analysis_map
+    if len(lost) < len(chunk):
+        recovery["salvaged"] += len(chunk) - len(lost)
+        parts = [lost]
+    else:
+        recovery["splits"] += 1
+        half = len(lost) // 2
+        parts = [lost[:half], lost[half:]]
+    recovery["retried"] += len(lost)
+    for part in parts:
+        analysis_map.update(await recover_batch(analyze, part, recovery, lost_ids))
+    return analysis_map
+
+async def stream_fetch_and_analyze(service, id_pages, gemini_api_key, user_id, threads=False, batch_sink=None):
+    """
+    Runs fetch -> parse -> Gemini as concurrent stages connected by bounded asyncio queues.
+    A Gemini batch is sent as soon as the packer has filled one (see batch_packer) while fetching continues,
+    and a full queue makes the upstream stage wait (backpressure).
+
+    With GMAIL_TRIAGE on, each chunk is first fetched as metadata (Subject/From/Date only) and
+    scored by triage.is_candidate; only candidates are downloaded with format='full'.
+
+    With threads=True, `id_pages` holds thread ids: each thread is fetched as metadata, only its
+    newest message goes on to triage and the full download, and the item records how many
+    messages the thread held (thread_message_count).
+
+    With GEMINI_CASCADE on, the packed batches go to a cheap yes/no triage model first and only its
+    positives are re-packed for the full extraction prompt. Per-tier latency and tokens are printed.
+
+    With `batch_sink`, extraction batches are handed to batch_sink(batch) instead of being sent
+    (bulk_analysis collects them into an offline batch job); nothing is analyzed in that case.
+
+    Returns (analyzed_items, processed_ids, fetch_errors, lost_ids). `lost_ids` are the message ids
+    whose Gemini answer was lost (including near-duplicates waiting on a lost representative);
+    they are left out of `processed_ids` so the next run asks again.
+    """
+    fetched_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    batch_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    analyzed_items = []
+    fetched_ids = []
+    triaged_out = []
+    collapsed = []
+    thread_sizes = {}
+    fetch_errors = {}
+    parse_stats = {"records": 0, "seconds": 0.0}
+    dedup_index = NearDuplicateIndex()
+    duplicates_of = []
+    analysis_by_id = {}
+    templates = get_template_store()
+    template_hits = []
+    llm_cache_hits = []
+    classifier = get_classifier() if SUBSCRIPTION_CLASSIFIER else None
+    classifier_skipped = []
+    examples = get_example_store() if CLASSIFIER_COLLECT else None
+    lost_ids = set()
+    usage = UsageStats()
+    # The caller's key joins the pool; batches go to whichever pooled key has the most quota left
+    gemini_pool = get_gemini_pool()
+    gemini_pool.add_key(gemini_api_key)
+    hedger = HedgePolicy()
+    batch_counter = {"sent": 0}
+    recovery = {"salvaged": 0, "retried": 0, "splits": 0, "lost": 0}
+    cache = get_message_cache()
 
-        arr = json.loads(text)
-        if not isinstance(arr, list):
+    async def fetch_stage():
+        async for page in id_pages:
+            for start in range(0, len(page), GMAIL_BATCH_SIZE):
+                chunk_ids = page[start:start + GMAIL_BATCH_SIZE]
+                if threads:
+                    await fetch_thread_chunk(chunk_ids)
+                else:
+                    await fetch_chunk(chunk_ids, GMAIL_TRIAGE)
+        await fetched_q.put(_DONE)
+
+    async def fetch_thread_chunk(thread_ids):
+        thread_map, errors = await run_blocking(
+            user_id, fetch_threads_batched, service, thread_ids, format='metadata',
+            metadataHeaders=TRIAGE_HEADERS, fields=THREAD_TRIAGE_FIELDS, user_key=user_id,
+        )
+        for thread_id, err in errors.items():
+            print(f"--> Failed to fetch thread {thread_id}: {err}")
+        fetch_errors.update(errors)
+
+        newest_ids = []
+        for thread_id in thread_ids:
+            thread_messages = thread_map.get(thread_id, {}).get("messages", [])
+            if not thread_messages:
+                continue
+            newest = max(thread_messages, key=lambda m: int(m.get("internalDate", 0)))
+            collapsed.extend(m["id"] for m in thread_messages if m is not newest)
+            thread_sizes[newest["id"]] = len(thread_messages)
+            # The thread metadata already carries the headers, so triage needs no extra call
+            if GMAIL_TRIAGE and not is_candidate(newest):
+                triaged_out.append(newest["id"])
+                continue
+            newest_ids.append(newest["id"])
+        await fetch_chunk(newest_ids, triage=False)
+
+    async def fetch_chunk(chunk_ids, triage):
+        # Messages are immutable: anything already in the local cache skips the API entirely
+        cached = await run_blocking(user_id, cache.get_many, user_id, chunk_ids)
+        cached_out = [(msg_id, cached[msg_id], None) for msg_id in chunk_ids if msg_id in cached]
+        chunk_ids = [msg_id for msg_id in chunk_ids if msg_id not in cached]
+        if not chunk_ids:
+            await fetched_q.put(cached_out)
+            return
+
+        if triage:
+            # Phase 1: headers only, then full bodies just for the likely candidates
+            metadata, errors = await run_blocking(
+                user_id, fetch_messages_batched, service, chunk_ids, format='metadata',
+                metadataHeaders=TRIAGE_HEADERS, fields=TRIAGE_FIELDS, user_key=user_id,
+            )
+            candidates = [msg_id for msg_id in chunk_ids if msg_id in metadata and is_candidate(metadata[msg_id])]
+            triaged_out.extend(msg_id for msg_id in chunk_ids if msg_id in metadata and msg_id not in candidates)
+            details, full_errors = await run_blocking(user_id, fetch_messages_batched, service, candidates, format='full', user_key=user_id)
+            errors.update(full_errors)
+        else:
+            details, errors = await run_blocking(user_id, fetch_messages_batched, service, chunk_ids, format='full', user_key=user_id)
+        for msg_id, err in errors.items():
+            print(f"--> Failed to fetch email {msg_id}: {err}")
+        fetch_errors.update(errors)
+        await fetched_q.put(cached_out + [(msg_id, None, details[msg_id]) for msg_id in chunk_ids if msg_id in details])
+
+    def new_extraction_packer():
+        if GEMINI_COMPACT_OUTPUT:
+            return BatchPacker(estimate_tokens(COMPACT_BATCH_PROMPT), output_tokens_per_item=COMPACT_OUTPUT_TOKENS_PER_ITEM)
+        return BatchPacker(estimate_tokens(BATCH_PROMPT))
+
+    def new_triage_packer():
+        return BatchPacker(estimate_tokens(TRIAGE_PROMPT), max_item_tokens=TRIAGE_ITEM_TOKENS,
+                           output_tokens_per_item=TRIAGE_OUTPUT_TOKENS_PER_ITEM)
+
+    def parse_chunk(chunk, first_id):
+        """
+        MIME parsing, SimHash dedup and template matching of one fetched chunk. CPU-bound, so it
+        runs on the I/O pool; only one chunk is parsed at a time, so the dedup index needs no lock.
+        Returns ([(msg_id, item, representative id, template extraction)], new cache fields).
+        """
+        parsed = []
+        new_fields = {}
+        for offset, (msg_id, fields, msg_detail) in enumerate(chunk):
+            started = time.perf_counter()
+            if fields is None:
+                record = EmailRecord.from_message(msg_id, msg_detail)
+                new_fields[msg_id] = record.cache_fields()
+            else:
+                record = EmailRecord.from_fields(msg_id, fields)
+            parse_stats["seconds"] += time.perf_counter() - started
+            parse_stats["records"] += 1
+            item = record.to_item(first_id + offset)
+            item["thread_message_count"] = thread_sizes.get(msg_id, 1)
+            # Near-identical copies (e.g. monthly receipts) reuse their representative's extraction
+            rep_id = dedup_index.representative_for(item) if GEMINI_DEDUP else None
+            # Senders with a learned template are extracted locally when the template is confident
+            local = templates.extract(user_id, item) if SENDER_TEMPLATES and rep_id is None else None
+            if rep_id is None and local is None:
+                # Compaction is memoized; doing it here spares the cache key and the packers on the event loop
+                fit_body(item["body"], MAX_ITEM_TOKENS)
+                if cascade:
+                    fit_body(item["body"], TRIAGE_ITEM_TOKENS)
+            parsed.append((msg_id, item, rep_id, local))
+        return parsed, new_fields
+
+    cascade = GEMINI_CASCADE and batch_sink is None
+    # One extraction packer for the whole run, so its per-batch stats cover every cascade re-pack.
+    # analyze_cascade adds and flushes without awaiting in between, so workers never interleave on it.
+    extraction_packer = new_extraction_packer() if cascade else None
+
+    async def parse_stage():
+        # With the cascade on, these are the (much larger) triage batches
+        packer = new_triage_packer() if cascade else new_extraction_packer()
+        while True:
+            chunk = await fetched_q.get()
+            if chunk is _DONE:
+                break
+            parsed, new_fields = await run_blocking(user_id, parse_chunk, chunk, len(fetched_ids))
+            to_analyze = []
+            for msg_id, item, rep_id, local in parsed:
+                fetched_ids.append(msg_id)
+                print(f"--> Fetched email {len(fetched_ids)}: {item['subject'][:50]}...")
+                if rep_id is not None:
+                    duplicates_of.append((rep_id, item))
+                    continue
+                if local is not None:
+                    analysis_by_id[item["id"]] = local
+                    analyzed_items.append({**item, **local})
+                    template_hits.append(item["id"])
+                    continue
+                to_analyze.append(item)
+
+            # Emails Gemini already answered under the same model and prompt version are not re-sent
+            cached = await lookup_extractions(to_analyze, GEMINI_MODEL_NAME, BATCH_PROMPT_VERSION)
+            for item in to_analyze:
+                if item["id"] in cached:
+                    llm_cache_hits.append(item["id"])
+                    if cached[item["id"]] is not None:
+                        analysis_by_id[item["id"]] = cached[item["id"]]
+                        analyzed_items.append({**item, **cached[item["id"]]})
+                    continue
+                # Emails the local classifier is confident are unrelated never reach Gemini
+                if classifier is not None and classifier.score(item) < CLASSIFIER_THRESHOLD:
+                    classifier_skipped.append(item["id"])
+                    continue
+                full = packer.add(item)
+                if full:
+                    await batch_q.put(full)
+            if new_fields:
+                await run_blocking(user_id, cache.put_many, user_id, new_fields)
+        last = packer.flush()
+        if last:
+            await batch_q.put(last)
+        print(f"{'Triage' if cascade else 'Batch'} packing: {packer.summary()}")
+        await batch_q.put(_DONE)
+
+    async def gemini_worker():
+        while True:
+            chunk = await batch_q.get()
+            if chunk is _DONE:
+                # Pass the sentinel on so every worker stops
+                await batch_q.put(_DONE)
+                break
+            if batch_sink is not None:
+                batch_sink(chunk)
+                continue
+            batch_counter["sent"] += 1
+            print(f"--> Sending batch {batch_counter['sent']}...")
+            analysis_map = await analyze_cascade(chunk) if cascade else await analyze_recovering(chunk)
+
+            answered = [item for item in chunk if item["id"] in analysis_map]
+            for item in answered:
+                analysis_by_id[item["id"]] = analysis_map[item["id"]]
+                analyzed_items.append({**item, **analysis_map[item["id"]]})
+            # Both stores write SQLite; one transaction per batch, off the event loop
+            if SENDER_TEMPLATES and answered:
+                await run_blocking(user_id, templates.learn_many, user_id, [(item, analysis_map[item["id"]]) for item in answered])
+            if examples is not None:
+                labeled = [item for item in chunk if item["id"] not in lost_ids]
+                await run_blocking(user_id, examples.add_many, labeled, [item["id"] in analysis_map for item in labeled])
+
+    async def analyze_recovering(chunk):
+        return await recover_batch(analyze_with_backoff, chunk, recovery, lost_ids)
+
+    async def analyze_cascade(chunk):
+        """Screens a triage batch on the cheap model, then runs the full extraction only on its positives."""
+        flagged = await call_with_backoff(triage_emails_with_gemini, chunk, estimate_triage_tokens(chunk), "triage")
+        if flagged is None:
             return {}
+        usage.add_emails("triage", len(chunk))
+        # The screen's "no" is the final answer for these, so it is cached like an extraction
+        negatives = [item for item in chunk if item["id"] not in flagged]
+        await store_extractions(negatives, {}, GEMINI_MODEL_NAME, BATCH_PROMPT_VERSION)
 
-        result = {item.get("id"): item for item in arr if isinstance(item, dict) and item.get("id") is not None and item.get("is_subscription")}
-        return result
-    except Exception as e:
-        print(f"Error during Gemini batch analysis: {e}")
-        return {}
+        batches = [batch for batch in (extraction_packer.add(item) for item in chunk if item["id"] in flagged) if batch]
+        last = extraction_packer.flush()
+        if last:
+            batches.append(last)
+        analysis_map = {}
+        for batch in batches:
+            analysis_map.update(await analyze_recovering(batch))
+        return analysis_map
 
-async def run_analysis(credentials, gemini_api_key, db: AsyncSession, user_id: int):
+    async def analyze_with_backoff(chunk):
+        # A hedge that comes back complete beats one with lost answers
+        result = await call_with_backoff(
+            analyze_emails_batch_with_gemini, chunk, estimate_batch_tokens(chunk), "extract", is_valid=lambda r: not r[1]
+        )
+        if result is None:
+            return {}, set()
+        analysis_map, missing = result
+        usage.add_emails("extract", len(chunk))
+        # Only answers Gemini actually gave are cached; lost ones must be asked again
+        answered = [item for item in chunk if item["id"] not in missing]
+        await store_extractions(answered, analysis_map, GEMINI_MODEL_NAME, BATCH_PROMPT_VERSION)
+        return analysis_map, missing
+
+    async def call_with_backoff(fn, chunk, tokens, tier, is_valid=lambda result: True):
+        """
+        Runs one Gemini call on the pooled key with the most headroom, backing off on 429s and
+        hedging slow calls (see gemini_hedge); None once retries run out.
+        """
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            async def send(running, api_key=None):
+                # The hedge takes quota of its own, possibly on another key
+                api_key = api_key or await gemini_pool.acquire(tokens)
+                loop = asyncio.get_running_loop()
+
+                def timed_call():
+                    # The hedge clock and the latency sample start on the pool thread, not while waiting for a slot
+                    loop.call_soon_threadsafe(running.set)
+                    began = time.monotonic()
+                    return fn(chunk, api_key, usage=usage), time.monotonic() - began
+
+                try:
+                    result, seconds = await run_gemini(user_id, timed_call)
+                except ResourceExhausted:
+                    gemini_pool.on_rate_limited(api_key, attempt)
+                    raise
+                gemini_pool.on_success(api_key)
+                hedger.record(tier, seconds)
+                return result
+
+            first_key = await gemini_pool.acquire(tokens)
+            try:
+                return await hedger.run(tier, lambda running: send(running, first_key), send, is_valid)
+            except ResourceExhausted as e:
+                print(f"--> Gemini rate limited (attempt {attempt + 1}): {e}")
+        print(f"--> Giving up on a batch of {len(chunk)} emails after {GEMINI_MAX_RETRIES + 1} rate-limited attempts.")
+        # Not re-sent (that would only add load), but never recorded as negatives either
+        lost_ids.update(item["id"] for item in chunk)
+        return None
+
+    stages = [fetch_stage, parse_stage] + [gemini_worker] * GEMINI_CONCURRENCY
+    tasks = [asyncio.create_task(stage()) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    # Copy each representative's extracted fields onto its duplicates, keeping their own message/date
+    for rep_id, item in duplicates_of:
+        analysis = analysis_by_id.get(rep_id)
+        if analysis is not None:
+            analyzed_items.append({**item, **{k: v for k, v in analysis.items() if k != "id"}})
+    if duplicates_of:
+        print(f"Near-duplicate collapsing skipped Gemini for {len(duplicates_of)} emails.")
+    if template_hits:
+        print(f"Sender templates extracted {len(template_hits)} emails without Gemini.")
+    if llm_cache_hits:
+        print(f"LLM extraction cache answered {len(llm_cache_hits)} emails.")
+    if classifier_skipped:
+        print(f"Local classifier skipped Gemini for {len(classifier_skipped)} emails (threshold {CLASSIFIER_THRESHOLD}).")
+    if extraction_packer is not None:
+        print(f"Extraction packing: {extraction_packer.summary()}")
+    print(f"Gemini usage: {usage.summary()}")
+    print(f"Gemini keys: {gemini_pool.summary()}")
+    print(f"Gemini latency: {hedger.summary()}")
+    if recovery["retried"] or recovery["lost"]:
+        print(f"Gemini recovery: {recovery['salvaged']} emails salvaged from malformed responses, "
+              f"{recovery['retried']} re-sent ({recovery['splits']} batch splits), {recovery['lost']} lost.")
+
+    if parse_stats["seconds"] > 0:
+        print(f"Parse stage: {parse_stats['records']} records in {parse_stats['seconds']:.3f}s "
+              f"({parse_stats['records'] / parse_stats['seconds']:.0f} records/s).")
+    print(f"Fetched {len(fetched_ids)} emails ({len(triaged_out)} skipped by header triage, {len(collapsed)} collapsed into threads).")
+    # Item ids index fetched_ids; a duplicate has no answer of its own when its representative's was lost
+    lost_ids.update(item["id"] for rep_id, item in duplicates_of if rep_id in lost_ids)
+    lost_message_ids = {fetched_ids[_id] for _id in lost_ids}
+    if lost_message_ids:
+        print(f"--> {len(lost_message_ids)} emails have no Gemini answer; they stay unprocessed for the next run.")
+    # Triaged-out and collapsed messages count as processed so incremental runs don't look at them again
+    processed = [msg_id for msg_id in fetched_ids if msg_id not in lost_message_ids] + triaged_out + collapsed
+    return analyzed_items, processed, fetch_errors, lost_message_ids
+
+async def _single_page(ids):
+    if ids:
+        yield ids
+
+async def load_previous_records(db: AsyncSession, user_id: int):
+    """Loads a user's stored analysis rows back into the shape run_analysis works with."""
+    query = select(models.GmailAnalysis).where(models.GmailAnalysis.user_id == user_id)
+    rows = (await db.execute(query)).scalars().all()
+    horizon = pd.Timestamp(dt.date.today() - dt.timedelta(days=GMAIL_HORIZON_DAYS), tz="UTC")
+
+    records = []
+    for row in rows:
+        try:
+            record = json.loads(row.analysis_result)
+        except (json.JSONDecodeError, TypeError):
+            continue
+        received = pd.to_datetime(record.get("receivedTime"), errors="coerce", utc=True)
+        if pd.isna(received) or received < horizon:
+            continue
+        record.pop("status", None)
+        record["sender"] = record.pop("from_name", None)
+        records.append(record)
+    return records
+
+def load_processed_ids(stored):
+    """
+    processed_message_ids as {message id: ISO date it was first processed}. Rows written before
+    the dates were kept hold a plain list; those ids are dated today.
+    """
+    if isinstance(stored, dict):
+        return dict(stored)
+    today = dt.date.today().isoformat()
+    return {msg_id: today for msg_id in stored or []}
+
+def prune_processed_ids(processed, horizon_days=GMAIL_HORIZON_DAYS):
+    """Drops ids processed before the sync horizon; history.list never reports those messages as added again."""
+    cutoff = (dt.date.today() - dt.timedelta(days=horizon_days)).isoformat()
+    return {msg_id: day for msg_id, day in processed.items() if day >= cutoff}
+
+async def select_sync_pages(service, db_creds, user_id):
+    """
+    Picks the messages a run has to look at: the ids history.list reports as added since the stored
+    checkpoint and not processed yet, or every message inside the horizon (full resync) when there
+    is no usable checkpoint. Nothing is written back; only run_analysis advances the checkpoint.
+
+    Returns (id_pages, threads, processed_ids, new_history_id, incremental). `processed_ids` is
+    empty after a full resync; `new_history_id` is the mailbox's historyId read before listing.
+    """
+    processed_ids = load_processed_ids(db_creds.processed_message_ids)
+
+    # Read the mailbox's current historyId before listing, so nothing added mid-run is skipped next time.
+    profile = await run_blocking(user_id, gmail_quota.execute, user_id, service.users().getProfile(userId='me'), 'getProfile')
+    new_history_id = profile.get('historyId')
+
+    new_ids = None
+    if db_creds.history_id and processed_ids:
+        new_ids = await run_blocking(user_id, list_history_message_ids, service, db_creds.history_id, user_key=user_id)
+        if new_ids is None:
+            print("--> History checkpoint expired, falling back to full resync.")
+
+    if new_ids is None:
+        # Pages are listed lazily as the fetch stage consumes them
+        id_pages = aiter_message_id_pages(service, user_id, build_sync_query(), threads=GMAIL_THREAD_MODE)
+        return id_pages, GMAIL_THREAD_MODE, {}, new_history_id, False
+    print(f"--> Incremental sync: {len(new_ids)} new messages since last run.")
+    id_pages = _single_page([msg_id for msg_id in new_ids if msg_id not in processed_ids])
+    return id_pages, False, processed_ids, new_history_id, True
+
+async def run_analysis(db_creds: models.GoogleCredentials, gemini_api_key, db: AsyncSession, user_id: int):
     # 1. Fetch Emails
     print("Step 1: Fetching emails...")
-    service = build('gmail', 'v1', credentials=credentials)
-    
-    six_months_ago = (dt.date.today() - dt.timedelta(days=180)).strftime('%Y/%m/%d')
-    query = f'-category:promotions -category:social in:anywhere after:{six_months_ago}'
-    
-    results = service.users().messages().list(userId='me', q=query, maxResults=500).execute()
-    messages = results.get('messages', [])
-    
-    email_data = []
-    for i, msg in enumerate(messages):
-        # Removed print spam for cleaner logs
-        msg_detail = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-        headers = msg_detail["payload"]["headers"]
-        subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), "")
-        
-        print(f"--> Fetched email {i+1}/{len(messages)}: {subject[:50]}...")
-
-        from_addr = next((h["value"] for h in headers if h["name"].lower() == "from"), "")
-        date_str = next((h["value"] for h in headers if h["name"].lower() == "date"), "")
-        
-        
-        try:
-            # Handle timezone information correctly
-            parsed_date = pd.to_datetime(date_str, errors='coerce').to_pydatetime()
-        except Exception:
-            parsed_date = None
-
-        body_text = get_plain_text_from_message(msg_detail)
-        
-        email_data.append({
-            "id": i, "message_id": msg["id"], "subject": subject,
-            "sender": from_addr, "body": body_text, "receivedTime": parsed_date,
-        })
-    print(f"Fetched {len(email_data)} emails.")
-
-    # 2. Analyze with Gemini in Batches
-    print("Step 2: Analyzing emails with Gemini...")
-    BATCH_SIZE = 20
-    all_analyzed_items = []
-    total_batches = (len(email_data) + BATCH_SIZE - 1) // BATCH_SIZE
-    for i in range(0, len(email_data), BATCH_SIZE):
-        chunk = email_data[i:i + BATCH_SIZE]
-        print(f"--> Sending batch {i//BATCH_SIZE + 1}/{total_batches}...")
-        analysis_map = analyze_emails_batch_with_gemini(chunk, gemini_api_key)
-        time.sleep(1.0) # Respect API rate limits
-
-        for item in chunk:
-            if item["id"] in analysis_map:
-                all_analyzed_items.append({**item, **analysis_map[item["id"]]})
-    
+    # Gmail and Gemini clients are blocking; run them on the shared I/O pool to keep the event loop free.
+    service, credentials = get_gmail_service(user_id, db_creds)
+
+    id_pages, use_threads, processed_ids, new_history_id, incremental = await select_sync_pages(service, db_creds, user_id)
+    previous_records = await load_previous_records(db, user_id) if incremental else []
+
+    await purge_stale_extractions(BATCH_PROMPT_VERSION)
+
+    # 2. Fetch, parse and analyze with Gemini as overlapping pipeline stages
+    print("Step 2: Fetching and analyzing emails with Gemini...")
+    all_analyzed_items, fetched_ids, fetch_errors, lost_ids = await stream_fetch_and_analyze(
+        service, id_pages, gemini_api_key, user_id, threads=use_threads
+    )
+
+    # Deleted messages (404) can never be fetched, so they count as processed like the rest
+    today = dt.date.today().isoformat()
+    gone = [msg_id for msg_id, err in fetch_errors.items() if gmail_quota.is_not_found(err)]
+    for msg_id in fetched_ids + gone:
+        processed_ids.setdefault(msg_id, today)
+    # Keep the old checkpoint while some fetches failed transiently or some answers were lost,
+    # so those messages are listed again next run
+    if not lost_ids and not any(gmail_quota.is_retryable(err) for err in fetch_errors.values()):
+        db_creds.history_id = new_history_id
+    db_creds.processed_message_ids = prune_processed_ids(processed_ids)
+    store_refreshed_token(db_creds, credentials)
+
+    # Merge with the results of earlier runs that are still inside the horizon
+    all_analyzed_items = previous_records + all_analyzed_items
     if not all_analyzed_items:
+        await db.commit()
         return []
     
     df = pd.DataFrame(all_analyzed_items)
@@ -177,7 +587,9 @@ async def run_analysis(credentials, gemini_api_key, db: AsyncSession, user_id: i
     df["receivedTime"] = pd.to_datetime(df["receivedTime"], errors="coerce", utc=True)
     df_clean = df.dropna(subset=["service_name", "receivedTime"]).copy()
     
-    if df_clean.empty: return []
+    if df_clean.empty:
+        await db.commit()
+        return []
 
     status_map = {}
     for service, group in df_clean.groupby("service_name"):
@@ -215,3 +627,4 @@ async def run_analysis(credentials, gemini_api_key, db: AsyncSession, user_id: i
     
     print("Analysis complete and saved.")
     return final_data
+
@@ -0,0 +1,83 @@
+import os
+import json
+
+from body_compaction import fit_body
+from gemini_limiter import estimate_tokens
+
+# Per-request budgets for packing emails into one Gemini call.
+GEMINI_INPUT_TOKEN_BUDGET = int(os.getenv("GEMINI_INPUT_TOKEN_BUDGET", "30000"))
+GEMINI_OUTPUT_TOKEN_BUDGET = int(os.getenv("GEMINI_OUTPUT_TOKEN_BUDGET", "4096"))
+# A single email never takes more than this, so one huge message can't crowd out a whole batch.
+MAX_ITEM_TOKENS = int(os.getenv("GEMINI_MAX_ITEM_TOKENS", "3000"))
+# Rough output size of one extracted JSON object, and of one positional row in compact mode.
+OUTPUT_TOKENS_PER_ITEM = 80
+COMPACT_OUTPUT_TOKENS_PER_ITEM = 30
+
+
+def prompt_line(item, max_item_tokens=MAX_ITEM_TOKENS):
+    """The one-line JSON an email is sent to Gemini as."""
+    return json.dumps({
+        "id": item["id"],
+        "subject": item["subject"],
+        "sender": item["sender"],
+        "body": fit_body(item["body"], max_item_tokens),
+    }, ensure_ascii=False)
+
+
+class BatchPacker:
+    """
+    Fills Gemini requests up to an input-token and an output-token budget instead of a fixed
+    item count, so short emails share large batches and long ones get smaller ones.
+
+    add() returns a finished batch whenever the next item would overflow the current one;
+    flush() returns whatever is left. Per-batch stats are kept in `stats`.
+    """
+
+    def __init__(self, prompt_tokens, input_budget=GEMINI_INPUT_TOKEN_BUDGET,
+                 output_budget=GEMINI_OUTPUT_TOKEN_BUDGET, max_item_tokens=MAX_ITEM_TOKENS,
+                 output_tokens_per_item=OUTPUT_TOKENS_PER_ITEM):
+        self.prompt_tokens = prompt_tokens
+        self.input_budget = input_budget
+        self.output_budget = output_budget
+        self.max_item_tokens = max_item_tokens
+        self.output_tokens_per_item = output_tokens_per_item
+        self.stats = []
+        self._items = []
+        self._input_tokens = prompt_tokens
+
+    def add(self, item):
+        tokens = estimate_tokens(prompt_line(item, self.max_item_tokens))
+        full = None
+        if self._items and (
+            self._input_tokens + tokens > self.input_budget
+            or (len(self._items) + 1) * self.output_tokens_per_item > self.output_budget
+        ):
+            full = self.flush()
+        self._items.append(item)
+        self._input_tokens += tokens
+        return full
+
+    def flush(self):
+        if not self._items:
+            return None
+        batch = self._items
+        self.stats.append({
+            "items": len(batch),
+            "input_tokens": self._input_tokens,
+            "output_tokens": len(batch) * self.output_tokens_per_item,
+            "input_fill": round(self._input_tokens / self.input_budget, 2),
+        })
+        self._items = []
+        self._input_tokens = self.prompt_tokens
+        return batch
+
+    def summary(self):
+        if not self.stats:
+            return "no batches"
+        items = sum(s["items"] for s in self.stats)
+        input_tokens = sum(s["input_tokens"] for s in self.stats)
+        return (
+            f"{len(self.stats)} batches, {items} emails, avg {items / len(self.stats):.1f} emails/batch, "
+            f"avg {input_tokens / len(self.stats):.0f} input tokens/batch, "
+            f"avg input fill {sum(s['input_fill'] for s in self.stats) / len(self.stats):.0%}"
+        )
@@ -0,0 +1,59 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared pool for blocking googleapiclient / google.generativeai calls so they never run on the event loop.
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "16"))
+# Max blocking calls a single user may have in flight at once.
+PER_USER_INFLIGHT = int(os.getenv("PER_USER_INFLIGHT", "4"))
+# Gemini calls take seconds each, so they get a budget of their own: otherwise a user's Gemini
+# workers hold every slot and the Gmail fetches and local store writes of the same run wait
+# behind them. Leaves room for the GEMINI_CONCURRENCY workers plus a hedge or two.
+PER_USER_GEMINI_INFLIGHT = int(os.getenv("PER_USER_GEMINI_INFLIGHT", "6"))
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix="blocking-io")
+_user_slots = {}
+_gemini_slots = {}
+
+
+def _slots_for(user_id, table=_user_slots, limit=PER_USER_INFLIGHT):
+    slots = table.get(user_id)
+    if slots is None:
+        slots = asyncio.Semaphore(limit)
+        table[user_id] = slots
+    return slots
+
+
+async def run_blocking(user_id, fn, *args, **kwargs):
+    """
+    Runs `fn(*args, **kwargs)` on the shared I/O pool, limited to PER_USER_INFLIGHT
+    concurrent calls per user, and awaits the result without blocking the event loop.
+
+    A pool thread can't be interrupted, so cancelling the caller (a lost hedge, a failed gather)
+    only stops the waiting: the user's slot stays taken until the call really returns.
+    """
+    return await _run_in_slot(_slots_for(user_id), fn, *args, **kwargs)
+
+
+async def run_gemini(user_id, fn, *args, **kwargs):
+    """Same as run_blocking for Gemini calls, limited by PER_USER_GEMINI_INFLIGHT instead."""
+    return await _run_in_slot(_slots_for(user_id, _gemini_slots, PER_USER_GEMINI_INFLIGHT), fn, *args, **kwargs)
+
+
+async def _run_in_slot(slots, fn, *args, **kwargs):
+    await slots.acquire()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(_io_pool, functools.partial(fn, *args, **kwargs))
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(functools.partial(_release_slot, slots))
+    return await asyncio.shield(future)
+
+
+def _release_slot(slots, future):
+    slots.release()
+    # Retrieve the outcome of a call nobody waits for any more, so it isn't logged as unhandled
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,145 @@
+import os
+import re
+import json
+from functools import lru_cache
+
+from gemini_limiter import estimate_tokens
+from mail_text import MONEY_PATTERN
+
+# Token budget for one email body sent to Gemini (the packer's per-item cap still applies on top).
+BODY_TOKEN_BUDGET = int(os.getenv("GEMINI_BODY_TOKENS", "800"))
+# Set to 0 to fall back to a plain cut of the first N tokens.
+BODY_COMPACTION = os.getenv("BODY_COMPACTION", "1") != "0"
+# Characters kept on each side of a money/date/keyword hit, and always kept from the top (sender, service, plan).
+WINDOW_CHARS = 160
+HEAD_CHARS = 300
+URL_KEEP_CHARS = 40
+
+# A reply header or signature delimiter ends the part worth reading (forward markers don't: the receipt follows them).
+_history_start = re.compile(
+    r"^(?:On .{0,200}wrote:|-{2,} ?Original Message ?-{2,}|-- ?$|Sent from my \w+"
+    r"|From: .+\n(?:.*\n){0,2}?Sent: |.{0,80}\d{4}년 .{0,60}작성:$|-{2,} ?원본 메일 ?-{2,})",
+    re.IGNORECASE | re.MULTILINE,
+)
+_quoted = re.compile(r"^>.*$\n?", re.MULTILINE)
+_url = re.compile(r"https?://\S+")
+_blank_runs = re.compile(r"\n\s*\n+")
+_spaces = re.compile(r"[ \t\r\f\v ]+")
+
+_date = re.compile(r"\b\d{4}[-./]\d{1,2}[-./]\d{1,2}\b|\d{4}년\s*\d{1,2}월\s*\d{1,2}일|\d{1,2}월\s*\d{1,2}일")
+_keyword = re.compile(
+    r"결제|청구|갱신|구독|요금제|멤버십|다음 결제|renew|invoice|receipt|next billing|billing|subscription|plan|membership|trial",
+    re.IGNORECASE,
+)
+
+
+def _shorten_url(match):
+    url = match.group(0)
+    return url if len(url) <= URL_KEEP_CHARS else url[:URL_KEEP_CHARS] + "…"
+
+
+def clean_body(text):
+    """Drops quoted history and signatures, shortens long URLs and collapses whitespace runs."""
+    text = (text or "").replace("\r\n", "\n")
+    cut = _history_start.search(text)
+    if cut and cut.start() > 0:
+        text = text[:cut.start()]
+    text = _quoted.sub("", text)
+    text = _url.sub(_shorten_url, text)
+    text = _spaces.sub(" ", text)
+    return _blank_runs.sub("\n", text).strip()
+
+
+def _fits(text, max_tokens):
+    return estimate_tokens(text) <= max_tokens
+
+
+def _cut(text, max_tokens):
+    encoded = text.encode("utf-8")
+    max_bytes = max_tokens * 4
+    return text if len(encoded) <= max_bytes else encoded[:max_bytes].decode("utf-8", errors="ignore")
+
+
+@lru_cache(maxsize=4096)
+def compact_body(text, max_tokens=BODY_TOKEN_BUDGET):
+    """
+    Cleans a body and, if it is still over `max_tokens`, keeps only the top of the email plus
+    windows around money amounts, dates and billing keywords (in that priority) until the budget
+    is spent. Windows are emitted in document order, joined by " … ".
+    """
+    text = clean_body(text)
+    if _fits(text, max_tokens):
+        return text
+
+    spans = [(0, min(HEAD_CHARS, len(text)))]
+    for pattern in (MONEY_PATTERN, _date, _keyword):
+        spans += [(max(0, m.start() - WINDOW_CHARS), min(len(text), m.end() + WINDOW_CHARS)) for m in pattern.finditer(text)]
+
+    kept = []
+    budget = max_tokens * 4
+    for start, end in spans:
+        # Only the part not already covered by a kept window costs budget
+        for kept_start, kept_end in kept:
+            if kept_start <= start < kept_end:
+                start = kept_end
+            if kept_start < end <= kept_end:
+                end = kept_start
+        if start >= end:
+            continue
+        size = len(text[start:end].encode("utf-8"))
+        if size > budget:
+            if not kept:
+                return _cut(text, max_tokens)
+            continue
+        kept.append((start, end))
+        budget -= size + 5
+
+    kept.sort()
+    merged = [list(kept[0])]
+    for start, end in kept[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return " … ".join(text[start:end].strip() for start, end in merged)
+
+
+def fit_body(body, max_tokens=BODY_TOKEN_BUDGET):
+    """What of `body` goes into the prompt: compacted windows, or the first `max_tokens` tokens with BODY_COMPACTION=0."""
+    if BODY_COMPACTION:
+        return compact_body(body or "", min(max_tokens, BODY_TOKEN_BUDGET))
+    return _cut(body or "", max_tokens)
+
+
+def evaluate(path, max_tokens=BODY_TOKEN_BUDGET):
+    """
+    Compares the plain first-N-tokens cut with compaction on a labeled JSONL set: one email per
+    line with "body" plus the expected values (e.g. "price", "next_billing_date", "service_name").
+    A label counts as kept when its value still appears in the text Gemini would see, which is
+    what extraction needs; input tokens are estimated the same way the packer does.
+    """
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    label_fields = ("service_name", "price", "next_billing_date", "start_date", "plan_name")
+    for name, shorten in (("first-N cut", _cut), ("compaction", compact_body)):
+        tokens = kept = labels = 0
+        for row in rows:
+            text = shorten(row.get("body") or "", max_tokens)
+            tokens += estimate_tokens(text)
+            lowered = _spaces.sub(" ", text).lower()
+            for field in label_fields:
+                value = row.get(field)
+                if value:
+                    labels += 1
+                    kept += str(value).lower() in lowered
+        print(f"{name:<12} avg {tokens / max(len(rows), 1):>6.0f} tokens/email, "
+              f"labels kept {kept}/{labels} ({kept / max(labels, 1):.1%})")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("usage: python body_compaction.py LABELED.jsonl [MAX_TOKENS]")
+    else:
+        evaluate(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else BODY_TOKEN_BUDGET)
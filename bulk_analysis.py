@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import datetime as dt
+
+import httpx
+from sqlalchemy.future import select
+
+import models
+from analysis_logic import run_analysis, select_sync_pages, stream_fetch_and_analyze
+from database import AsyncSessionLocal
+from gemini_prompts import BATCH_PROMPT_VERSION, GEMINI_COMPACT_OUTPUT, GEMINI_MODEL_NAME, build_batch_prompt, decode_batch_response
+from gmail_service import get_gmail_service, store_refreshed_token
+from llm_cache import store_extractions
+
+# Where job files, manifests and (for the local backend) results are written.
+BULK_JOB_DIR = os.getenv("BULK_JOB_DIR", "bulk_jobs")
+BULK_POLL_SECONDS = float(os.getenv("BULK_POLL_SECONDS", "60"))
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com"
+
+
+def request_line(key, email_items):
+    """One line of a Gemini batch job: the same prompt the synchronous path sends for this batch."""
+    request = {"contents": [{"role": "user", "parts": [{"text": build_batch_prompt(email_items)}]}]}
+    if GEMINI_COMPACT_OUTPUT:
+        request["generation_config"] = {"response_mime_type": "application/json"}
+    return {"key": key, "request": request}
+
+
+def response_text(response):
+    """The answer text of a GenerateContentResponse in REST/JSON form, or None if it was blocked or empty."""
+    candidates = (response or {}).get("candidates") or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts) or None
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Gemini batch API, for running the bulk flow offline. A job is
+    "running" on the first poll and answered on the second, each request by `responder(request)`
+    (default: no subscriptions found). Its made-up answers are cached under a prompt version of
+    their own, so run_analysis never looks them up (and purges them on its next run).
+    """
+
+    prompt_version = BATCH_PROMPT_VERSION + "-local"
+
+    def __init__(self, root=os.path.join(BULK_JOB_DIR, "local"), responder=None):
+        self.root = root
+        self.responder = responder or (lambda request: "[]")
+
+    async def submit(self, path, model_name):
+        name = f"local-{dt.datetime.now():%Y%m%d-%H%M%S-%f}"
+        job_dir = os.path.join(self.root, name)
+        os.makedirs(job_dir)
+        shutil.copy(path, os.path.join(job_dir, "input.jsonl"))
+        with open(os.path.join(job_dir, "state"), "w") as f:
+            f.write("pending")
+        return name
+
+    async def state(self, name):
+        job_dir = os.path.join(self.root, name)
+        with open(os.path.join(job_dir, "state")) as f:
+            state = f.read()
+        if state == "pending":
+            state = "running"
+        elif state == "running":
+            with open(os.path.join(job_dir, "input.jsonl"), encoding="utf-8") as src, \
+                    open(os.path.join(job_dir, "output.jsonl"), "w", encoding="utf-8") as out:
+                for line in src:
+                    line = json.loads(line)
+                    text = self.responder(line["request"])
+                    response = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+                    out.write(json.dumps({"key": line["key"], "response": response}, ensure_ascii=False) + "\n")
+            state = "succeeded"
+        with open(os.path.join(job_dir, "state"), "w") as f:
+            f.write(state)
+        return state
+
+    async def results(self, name):
+        with open(os.path.join(self.root, name, "output.jsonl"), encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        return [(line["key"], response_text(line.get("response"))) for line in lines]
+
+
+class GeminiBatchBackend:
+    """Gemini batch mode over REST: upload the JSONL via the Files API, create the batch, poll it, download the results."""
+
+    _STATES = {
+        "BATCH_STATE_PENDING": "running", "BATCH_STATE_RUNNING": "running", "BATCH_STATE_SUCCEEDED": "succeeded",
+        "BATCH_STATE_FAILED": "failed", "BATCH_STATE_CANCELLED": "failed", "BATCH_STATE_EXPIRED": "failed",
+    }
+
+    prompt_version = BATCH_PROMPT_VERSION
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self._responses_files = {}
+
+    async def submit(self, path, model_name):
+        with open(path, "rb") as f:
+            data = f.read()
+        async with httpx.AsyncClient(timeout=300) as client:
+            start = await client.post(
+                f"{GEMINI_API_BASE}/upload/v1beta/files", params={"key": self.api_key},
+                headers={
+                    "X-Goog-Upload-Protocol": "resumable", "X-Goog-Upload-Command": "start",
+                    "X-Goog-Upload-Header-Content-Length": str(len(data)),
+                    "X-Goog-Upload-Header-Content-Type": "application/jsonl",
+                },
+                json={"file": {"display_name": os.path.basename(path)}},
+            )
+            start.raise_for_status()
+            upload = await client.post(
+                start.headers["x-goog-upload-url"], content=data,
+                headers={"X-Goog-Upload-Offset": "0", "X-Goog-Upload-Command": "upload, finalize"},
+            )
+            upload.raise_for_status()
+            file_name = upload.json()["file"]["name"]
+
+            created = await client.post(
+                f"{GEMINI_API_BASE}/v1beta/models/{model_name}:batchGenerateContent", params={"key": self.api_key},
+                json={"batch": {"display_name": os.path.basename(os.path.dirname(path)), "input_config": {"file_name": file_name}}},
+            )
+            created.raise_for_status()
+            return created.json()["name"]
+
+    async def state(self, name):
+        async with httpx.AsyncClient(timeout=60) as client:
+            resp = await client.get(f"{GEMINI_API_BASE}/v1beta/{name}", params={"key": self.api_key})
+        resp.raise_for_status()
+        body = resp.json()
+        metadata = body.get("metadata") or {}
+        state = self._STATES.get(metadata.get("state"), "running")
+        if state == "succeeded":
+            output = (body.get("response") or {}).get("responsesFile") or (metadata.get("output") or {}).get("responsesFile")
+            self._responses_files[name] = output
+        return state
+
+    async def results(self, name):
+        async with httpx.AsyncClient(timeout=600) as client:
+            resp = await client.get(
+                f"{GEMINI_API_BASE}/download/v1beta/{self._responses_files[name]}:download",
+                params={"alt": "media", "key": self.api_key},
+            )
+        resp.raise_for_status()
+        lines = [json.loads(line) for line in resp.text.splitlines() if line.strip()]
+        return [(line["key"], response_text(line.get("response"))) for line in lines]
+
+
+async def collect_user_batches(db_creds, user_id):
+    """
+    The extraction batches run_analysis would send for a user, without sending them. The messages
+    are picked exactly as run_analysis picks them (select_sync_pages), and the checkpoint is left alone.
+    """
+    service, credentials = get_gmail_service(user_id, db_creds)
+    id_pages, threads, _, _, _ = await select_sync_pages(service, db_creds, user_id)
+    batches = []
+    await stream_fetch_and_analyze(service, id_pages, None, user_id, threads=threads, batch_sink=batches.append)
+    store_refreshed_token(db_creds, credentials)
+    return batches
+
+
+async def prepare_job(backend):
+    """Collects every user's pending batches into one JSONL job, submits it and returns the job directory."""
+    job_dir = os.path.join(BULK_JOB_DIR, f"{dt.datetime.now():%Y%m%d-%H%M%S}")
+    os.makedirs(job_dir)
+    requests_path = os.path.join(job_dir, "requests.jsonl")
+    user_ids = []
+    lines = 0
+
+    async with AsyncSessionLocal() as db:
+        all_creds = (await db.execute(select(models.GoogleCredentials))).scalars().all()
+        with open(requests_path, "w", encoding="utf-8") as requests_file, \
+                open(os.path.join(job_dir, "manifest.jsonl"), "w", encoding="utf-8") as manifest:
+            for db_creds in all_creds:
+                try:
+                    batches = await collect_user_batches(db_creds, db_creds.user_id)
+                except Exception as e:
+                    # One broken mailbox must not stop the nightly run
+                    print(f"--> Skipping user {db_creds.user_id}: {e}")
+                    continue
+                user_ids.append(db_creds.user_id)
+                for n, batch in enumerate(batches):
+                    key = f"u{db_creds.user_id}-b{n}"
+                    requests_file.write(json.dumps(request_line(key, batch), ensure_ascii=False) + "\n")
+                    items = [{k: item[k] for k in ("id", "message_id", "subject", "sender", "body")} for item in batch]
+                    manifest.write(json.dumps({"key": key, "user_id": db_creds.user_id, "items": items}, ensure_ascii=False) + "\n")
+                    lines += 1
+        await db.commit()
+
+    job = {"user_ids": user_ids, "requests": lines, "model": GEMINI_MODEL_NAME, "prompt_version": backend.prompt_version}
+    if lines:
+        job["name"] = await backend.submit(requests_path, GEMINI_MODEL_NAME)
+    with open(os.path.join(job_dir, "job.json"), "w") as f:
+        json.dump(job, f)
+    print(f"Prepared {lines} batch requests for {len(user_ids)} users in {job_dir}" + (f", submitted as {job['name']}." if lines else "."))
+    return job_dir
+
+
+async def apply_results(job_dir, results, prompt_version=BATCH_PROMPT_VERSION):
+    """Maps batch answers back to their emails and stores them in the LLM extraction cache under `prompt_version`."""
+    with open(os.path.join(job_dir, "manifest.jsonl"), encoding="utf-8") as f:
+        manifest = {entry["key"]: entry for entry in map(json.loads, f)}
+    answered = lost = 0
+    for key, text in results:
+        entry = manifest.get(key)
+        if entry is None:
+            continue
+        items = entry["items"]
+        if text is None:
+            lost += len(items)
+            continue
+        analysis_map, missing = decode_batch_response(text, items)
+        # Lost answers stay uncached, so the follow-up run_analysis asks for them synchronously
+        done = [item for item in items if item["id"] not in missing]
+        await store_extractions(done, analysis_map, GEMINI_MODEL_NAME, prompt_version)
+        answered += len(done)
+        lost += len(missing)
+    print(f"Batch job answered {answered} emails ({lost} without a usable answer).")
+
+
+async def run_bulk(backend, gemini_api_key, job_dir=None, reanalyze=True):
+    """
+    Nightly bulk analysis: prepare and submit a job (or resume `job_dir`), poll until it finishes,
+    cache its answers, then run the normal per-user analysis, which now hits the cache instead
+    of calling Gemini. A backend whose answers are cached under another prompt version (the local
+    stand-in) would have that analysis call Gemini for real and advance every checkpoint, so it
+    only runs with reanalyze=False.
+    """
+    if reanalyze and backend.prompt_version != BATCH_PROMPT_VERSION:
+        raise ValueError(f"{type(backend).__name__} answers are cached as {backend.prompt_version}; run it with reanalyze=False.")
+    job_dir = job_dir or await prepare_job(backend)
+    with open(os.path.join(job_dir, "job.json")) as f:
+        job = json.load(f)
+    if job["prompt_version"] != backend.prompt_version:
+        print(f"Job was built for prompt {job['prompt_version']}, current is {backend.prompt_version}; its answers would never be looked up.")
+        return
+
+    if job.get("name"):
+        started = time.monotonic()
+        while (state := await backend.state(job["name"])) == "running":
+            print(f"--> {job['name']} still running ({time.monotonic() - started:.0f}s)...")
+            await asyncio.sleep(BULK_POLL_SECONDS)
+        if state != "succeeded":
+            print(f"Batch job {job['name']} ended as {state}.")
+            return
+        await apply_results(job_dir, await backend.results(job["name"]), job["prompt_version"])
+
+    if not reanalyze:
+        return
+    async with AsyncSessionLocal() as db:
+        for user_id in job["user_ids"]:
+            db_creds = (await db.execute(
+                select(models.GoogleCredentials).where(models.GoogleCredentials.user_id == user_id)
+            )).scalars().first()
+            if db_creds is None:
+                continue
+            try:
+                await run_analysis(db_creds, gemini_api_key, db, user_id)
+            except Exception as e:
+                await db.rollback()
+                print(f"--> Re-analysis failed for user {user_id}: {e}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline bulk re-analysis of every connected mailbox via a Gemini batch job")
+    parser.add_argument("--local", action="store_true", help="use the file-based stand-in backend instead of Gemini (needs --no-reanalyze)")
+    parser.add_argument("--resume", metavar="JOB_DIR", help="poll and apply an already submitted job")
+    parser.add_argument("--no-reanalyze", action="store_true", help="only fill the extraction cache")
+    args = parser.parse_args()
+    if args.local and not args.no_reanalyze:
+        parser.error("--local answers are made up and never used by the analysis; pass --no-reanalyze")
+
+    api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+    backend = LocalBatchBackend() if args.local else GeminiBatchBackend(api_key)
+    asyncio.run(run_bulk(backend, api_key, job_dir=args.resume, reanalyze=not args.no_reanalyze))
@@ -1,11 +1,29 @@
 import asyncio
+from sqlalchemy import inspect, text
 from database import engine, Base
 from models import User, GmailAnalysis
 
+# Columns added to existing tables after they were first created; create_all never alters a table.
+# Only the ones a table is still missing are added, so this runs safely on each startup
+# (plain ADD COLUMN, which Postgres and SQLite both understand).
+MIGRATED_COLUMNS = {
+    "google_credentials": ["expiry", "history_id", "processed_message_ids"],
+}
+
+def migrate(conn):
+    for table_name, column_names in MIGRATED_COLUMNS.items():
+        existing = {column["name"] for column in inspect(conn).get_columns(table_name)}
+        table = Base.metadata.tables[table_name]
+        for name in column_names:
+            if name not in existing:
+                column_type = table.c[name].type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"))
+
 async def create_tables():
     async with engine.begin() as conn:
         # This will create tables if they do not exist
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate)
 
 if __name__ == "__main__":
     asyncio.run(create_tables())
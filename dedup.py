@@ -0,0 +1,69 @@
+import os
+import re
+import hashlib
+from email.utils import parseaddr
+
+import numpy as np
+
+from mail_text import MONEY_PATTERN
+
+# Max differing bits between two 64-bit SimHashes for emails to count as near-duplicates.
+SIMHASH_MAX_DISTANCE = int(os.getenv("SIMHASH_MAX_DISTANCE", "3"))
+SHINGLE_SIZE = 3
+
+_url = re.compile(r"https?://\S+")
+_digits = re.compile(r"\d+")
+_word = re.compile(r"\w+")
+_BIT_VALUES = np.uint64(1) << np.arange(64, dtype=np.uint64)
+
+
+def normalize(text):
+    """Lowercases, drops URLs and masks digits, so dates/order numbers don't split a cluster."""
+    text = _url.sub(" ", (text or "").lower())
+    return _digits.sub("0", text)
+
+
+def simhash(text):
+    tokens = _word.findall(normalize(text))
+    if len(tokens) >= SHINGLE_SIZE:
+        features = [" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)]
+    else:
+        features = [" ".join(tokens)]
+
+    digests = b"".join(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest() for feature in features)
+    hashes = np.frombuffer(digests, dtype=">u8").astype(np.uint64)
+    # Per bit: +1 for every shingle hash that has it set, -1 for every one that doesn't
+    set_counts = ((hashes[:, None] & _BIT_VALUES) != 0).sum(axis=0)
+    return int(np.bitwise_or.reduce(_BIT_VALUES[2 * set_counts > len(features)], initial=np.uint64(0)))
+
+
+def cluster_key(item):
+    """
+    Emails are only compared within the same sender address and the same set of amounts,
+    so receipts whose price changed are never merged.
+    """
+    address = parseaddr(item.get("sender") or "")[1].lower()
+    text = f"{item.get('subject') or ''}\n{item.get('body') or ''}"
+    amounts = tuple(sorted({re.sub(r"\s+", "", m).lower() for m in MONEY_PATTERN.findall(text)}))
+    return address, amounts
+
+
+class NearDuplicateIndex:
+    """Keeps one representative per cluster of near-identical emails (SimHash over subject + body)."""
+
+    def __init__(self, max_distance=SIMHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.buckets = {}
+        self.duplicates = 0
+
+    def representative_for(self, item):
+        """Returns the id of an earlier near-identical item, or None after registering `item` as a new representative."""
+        key = cluster_key(item)
+        fingerprint = simhash(f"{item.get('subject') or ''}\n{item.get('body') or ''}")
+        bucket = self.buckets.setdefault(key, [])
+        for rep_fingerprint, rep_id in bucket:
+            if bin(rep_fingerprint ^ fingerprint).count("1") <= self.max_distance:
+                self.duplicates += 1
+                return rep_id
+        bucket.append((fingerprint, item["id"]))
+        return None
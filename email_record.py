@@ -0,0 +1,74 @@
+import datetime as dt
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+from mail_text import get_plain_text_from_message
+
+_WANTED_HEADERS = {"subject", "from", "date"}
+
+
+def parse_date(date_str):
+    """Parses an RFC 2822 Date header into an aware datetime (naive values are taken as UTC), or None."""
+    if not date_str:
+        return None
+    try:
+        parsed = parsedate_to_datetime(date_str)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc)
+    return parsed
+
+
+@dataclass(slots=True)
+class EmailRecord:
+    """The parts of a Gmail message analysis uses, built with a single pass over the headers."""
+
+    message_id: str
+    subject: str = ""
+    sender: str = ""
+    date: str = ""
+    body: str = ""
+    received: dt.datetime | None = None
+
+    @classmethod
+    def from_message(cls, msg_id, msg_detail):
+        found = {}
+        for header in msg_detail.get("payload", {}).get("headers", []):
+            name = header["name"].lower()
+            if name in _WANTED_HEADERS and name not in found:
+                found[name] = header["value"]
+                if len(found) == len(_WANTED_HEADERS):
+                    break
+        date_str = found.get("date", "")
+        return cls(
+            message_id=msg_id,
+            subject=found.get("subject", ""),
+            sender=found.get("from", ""),
+            date=date_str,
+            body=get_plain_text_from_message(msg_detail),
+            received=parse_date(date_str),
+        )
+
+    @classmethod
+    def from_fields(cls, msg_id, fields):
+        """Rebuilds a record from the dict stored in the message cache."""
+        date_str = fields.get("date") or ""
+        return cls(
+            message_id=msg_id,
+            subject=fields.get("subject") or "",
+            sender=fields.get("sender") or "",
+            date=date_str,
+            body=fields.get("body") or "",
+            received=parse_date(date_str),
+        )
+
+    def cache_fields(self):
+        return {"subject": self.subject, "sender": self.sender, "date": self.date, "body": self.body}
+
+    def to_item(self, item_id):
+        """The dict shape run_analysis passes to Gemini batching and the DataFrame."""
+        return {
+            "id": item_id, "message_id": self.message_id, "subject": self.subject,
+            "sender": self.sender, "body": self.body, "receivedTime": self.received,
+        }
@@ -1,12 +1,15 @@
 from __future__ import annotations
 import os
 import time
-import json
 from dotenv import load_dotenv
 
 import pandas as pd
 import google.generativeai as genai
 
+from batch_packer import COMPACT_OUTPUT_TOKENS_PER_ITEM, BatchPacker, prompt_line
+from gemini_response import expand_rows, parse_json_array
+from gemini_limiter import estimate_tokens
+
 # ============================================
 # 1. Gemini 설정
 # ============================================
@@ -24,6 +27,7 @@ else:
     genai.configure(api_key=GEMINI_API_KEY)
 
 model = genai.GenerativeModel(MODEL_NAME)
+json_model = genai.GenerativeModel(MODEL_NAME, generation_config={"response_mime_type": "application/json"})
 
 # ============================================
 # 2. 배치 분석용 프롬프트
@@ -66,6 +70,35 @@ BATCH_PROMPT = """
 구독 관련 이메일이 하나도 없다면 빈 배열 []만 출력하세요.
 """
 
+# 출력 토큰 절약용: 키 없이 값만 순서대로 담은 행(row) 배열로 받기
+COMPACT_BATCH_PROMPT = """
+당신은 이메일에서 '구독/정기결제/뉴스레터/멤버십' 정보를 추출하는 분석기입니다.
+
+입력으로 여러 개의 이메일 목록이 주어집니다.
+각 이메일은 JSON 한 줄로 표현되며, 형식은 다음과 같습니다.
+
+{"id": 1, "subject": "...", "sender": "...", "body": "..."}
+
+구독/정기결제/뉴스레터/멤버십 관련 이메일마다 키 없이 아래 순서의 값만 담은 JSON 배열 한 줄을 출력하세요.
+[id, service_name, plan_name, price, currency, billing_cycle, start_date, next_billing_date, unsubscribe_link, category, raw_summary]
+
+- price는 금액 문자열, currency는 KRW, USD 등. 모르는 값은 null
+- billing_cycle은 한 글자: m(monthly), y(yearly), w(weekly), o(once), u(unknown)
+- 날짜는 YYYY-MM-DD
+- category는 streaming / news / shopping / cloud / app / other
+- raw_summary는 구독 내용 한 줄 요약
+
+예: [[1, "넷플릭스", "프리미엄", "17000", "KRW", "m", null, "2025-01-05", null, "streaming", "넷플릭스 프리미엄 월 결제"]]
+무관한 이메일은 제외하고, 하나도 없다면 []만 출력하세요.
+"""
+COMPACT_FIELDS = (
+    "id", "service_name", "plan_name", "price", "currency", "billing_cycle",
+    "start_date", "next_billing_date", "unsubscribe_link", "category", "raw_summary",
+)
+
+# 1이면 압축 행 포맷 + JSON 모드, 0이면 기존 키-값 객체 포맷
+COMPACT_OUTPUT = os.getenv("GEMINI_COMPACT_OUTPUT", "1") != "0"
+
 
 # ============================================
 # 3. Gemini 배치 분석 함수
@@ -85,40 +118,26 @@ def analyze_emails_batch_with_gemini(email_items):
     if not email_items:
         return {}
 
-    # 이메일들을 한 줄짜리 JSON로 이어붙임
-    lines = []
-    for item in email_items:
-        body = item["body"] or ""
-        # 토큰 아끼려고 너무 길면 자르기 (필요시 숫자 조정 가능)
-        if len(body) > 3000:
-            body = body[:3000]
-
-        obj = {
-            "id": item["id"],
-            "subject": item["subject"],
-            "sender": item["sender"],
-            "body": body,
-        }
-        lines.append(json.dumps(obj, ensure_ascii=False))
+    # 이메일들을 한 줄짜리 JSON로 이어붙임 (본문은 메일당 토큰 상한까지만)
+    joined = "\n".join(prompt_line(item) for item in email_items)
 
-    joined = "\n".join(lines)
-
-    prompt = BATCH_PROMPT + "\n\n### 이메일 목록\n" + joined
+    if COMPACT_OUTPUT:
+        prompt = COMPACT_BATCH_PROMPT + "\n\n### 이메일 목록\n" + joined
+    else:
+        prompt = BATCH_PROMPT + "\n\n### 이메일 목록\n" + joined
 
     try:
-        resp = model.generate_content(prompt)
-        text = resp.text.strip()
-
-        # 혹시 ```json ...``` 이런 식으로 나오면 정리
-        text = text.strip("`").strip()
-        if text.lower().startswith("json"):
-            text = text[4:].strip()
-
-        arr = json.loads(text)
-
-        if not isinstance(arr, list):
-            print("⚠ 예기치 않은 응답 형식(리스트 아님):", type(arr))
-            return {}
+        if COMPACT_OUTPUT:
+            resp = json_model.generate_content(prompt)
+            rows, complete = parse_json_array(resp.text, element_type=list)
+            # 행 → 기존과 같은 필드 dict로 복원
+            arr = list(expand_rows(rows, COMPACT_FIELDS).values())
+        else:
+            resp = model.generate_content(prompt)
+            # 깨진 JSON이어도 완성된 객체는 최대한 건짐 (```json ...``` 감싸기도 정리)
+            arr, complete = parse_json_array(resp.text)
+        if not complete:
+            print(f"⚠ 응답 JSON이 깨져 있음: {len(email_items)}통 중 {len(arr)}건만 건짐")
 
         result = {}
         for item in arr:
@@ -162,30 +181,26 @@ def main():
     # 인덱스를 id로 쓰기 위해 reset_index
     df = df.reset_index().rename(columns={"index": "row_id"})
 
-    # 한 번에 20통씩 배치 분석
-    BATCH_SIZE = 20
-
-    all_rows = []
-
-    total_rows = len(df)
-
-    for start in range(0, total_rows, BATCH_SIZE):
-        end = min(start + BATCH_SIZE, total_rows)
-        chunk = df.iloc[start:end]
-
-        email_items = []
-        for _, row in chunk.iterrows():
-            row_id = int(row["row_id"])
-            subject = str(row.get("subject", "(제목 없음)"))
-            from_name = str(row.get("from_name", "")) or "(보낸이 없음)"
-            from_email = str(row.get("from_email", "")) or ""
-            preview = str(row.get("preview", ""))
-            body_snippet = str(row.get("body_snippet", ""))
-            received_time = str(row.get("receivedTime", ""))
-
-            sender = f"{from_name} <{from_email}>" if from_email else from_name
-
-            body_text = f"""
+    # 고정 20통 대신 토큰 예산만큼 채워서 배치 구성 (짧은 메일은 많이, 긴 메일은 적게)
+    if COMPACT_OUTPUT:
+        packer = BatchPacker(estimate_tokens(COMPACT_BATCH_PROMPT), output_tokens_per_item=COMPACT_OUTPUT_TOKENS_PER_ITEM)
+    else:
+        packer = BatchPacker(estimate_tokens(BATCH_PROMPT))
+    batches = []
+    rows_by_id = {}
+
+    for _, row in df.iterrows():
+        row_id = int(row["row_id"])
+        subject = str(row.get("subject", "(제목 없음)"))
+        from_name = str(row.get("from_name", "")) or "(보낸이 없음)"
+        from_email = str(row.get("from_email", "")) or ""
+        preview = str(row.get("preview", ""))
+        body_snippet = str(row.get("body_snippet", ""))
+        received_time = str(row.get("receivedTime", ""))
+
+        sender = f"{from_name} <{from_email}>" if from_email else from_name
+
+        body_text = f"""
 [요약 정보]
 제목: {subject}
 보낸 사람: {sender}
@@ -198,14 +213,25 @@ def main():
 {body_snippet}
 """.strip()
 
-            email_items.append({
-                "id": row_id,
-                "subject": subject,
-                "sender": sender,
-                "body": body_text,
-            })
+        rows_by_id[row_id] = row
+        full = packer.add({
+            "id": row_id,
+            "subject": subject,
+            "sender": sender,
+            "body": body_text,
+        })
+        if full:
+            batches.append(full)
+
+    last = packer.flush()
+    if last:
+        batches.append(last)
+    print(f"📦 배치 구성: {packer.summary()}")
+
+    all_rows = []
 
-        print(f"🔎 {start+1} ~ {end}번째 메일 배치 분석 중...")
+    for batch_no, email_items in enumerate(batches, start=1):
+        print(f"🔎 {batch_no}/{len(batches)}번째 배치 분석 중... ({len(email_items)}통)")
 
         analysis_map = analyze_emails_batch_with_gemini(email_items)
 
@@ -213,10 +239,11 @@ def main():
         time.sleep(1.0)
 
         # 분석 결과를 원본 row와 매칭
-        for _, row in chunk.iterrows():
-            row_id = int(row["row_id"])
+        for item in email_items:
+            row_id = item["id"]
             if row_id not in analysis_map:
                 continue
+            row = rows_by_id[row_id]
             analysis = analysis_map[row_id]
 
             all_rows.append({
@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+import threading
+
+# Hedged requests: re-send a batch that is slower than the recent p95 and take whichever answer comes first.
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "0") == "1"
+# At most this share of a run's calls may be duplicated.
+GEMINI_HEDGE_MAX_RATE = float(os.getenv("GEMINI_HEDGE_MAX_RATE", "0.1"))
+HEDGE_QUANTILE = 0.95
+# Until a tier has this many samples its deadline is HEDGE_INITIAL_SECONDS.
+HEDGE_MIN_SAMPLES = 10
+HEDGE_INITIAL_SECONDS = float(os.getenv("GEMINI_HEDGE_INITIAL_SECONDS", "20"))
+HEDGE_MIN_SECONDS = 1.0
+LATENCY_WINDOW = 200
+
+# Recent call latencies per tier, shared by every run in the process: a single run is usually far
+# too short to collect HEDGE_MIN_SAMPLES of its own.
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HedgePolicy:
+    """
+    Per-run request hedging. A call still running at its tier's adaptive p95 deadline gets a
+    duplicate; the first successful, valid answer wins and the other task is cancelled. Blocking
+    calls already on the I/O pool can't be aborted, so a cancelled loser only has its answer dropped.
+    Hedges are capped at `max_rate` of the run's calls.
+
+    The deadline comes from the process-wide latency window (or `latencies`, if given); the
+    counters and the cap are per instance.
+    """
+
+    def __init__(self, enabled=GEMINI_HEDGE, max_rate=GEMINI_HEDGE_MAX_RATE, latencies=None):
+        self.enabled = enabled
+        self.max_rate = max_rate
+        self.latencies = _latencies if latencies is None else latencies
+        self.batch_seconds = []
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, tier, seconds):
+        """Running time of one finished call (not its wait for a slot), feeding that tier's deadline."""
+        with _latencies_lock:
+            samples = self.latencies.setdefault(tier, [])
+            samples.append(seconds)
+            del samples[:-LATENCY_WINDOW]
+
+    def deadline(self, tier):
+        with _latencies_lock:
+            samples = list(self.latencies.get(tier, []))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_INITIAL_SECONDS
+        return max(HEDGE_MIN_SECONDS, percentile(samples, HEDGE_QUANTILE))
+
+    async def run(self, tier, make_call, make_hedge=None, is_valid=lambda result: True):
+        """
+        Awaits make_call(running), hedging it with make_hedge(running) (default: make_call) past
+        the deadline. `running` is an asyncio.Event the call sets once it is actually executing
+        (e.g. on a pool thread): the deadline counts from there, so a call still queued for a slot
+        or for quota is never hedged. Returns the first valid result (or the first result at all
+        if none is valid); raises only if every attempt raised.
+        """
+        self.calls += 1
+        started = time.monotonic()
+        running = asyncio.Event()
+        first = asyncio.ensure_future(make_call(running))
+        tasks = [first]
+        waiting = None
+        try:
+            if self.enabled:
+                waiting = asyncio.ensure_future(running.wait())
+                await asyncio.wait([first, waiting], return_when=asyncio.FIRST_COMPLETED)
+                if not first.done():
+                    await asyncio.wait(tasks, timeout=self.deadline(tier))
+                if not first.done() and self.hedges + 1 <= self.max_rate * self.calls:
+                    self.hedges += 1
+                    tasks.append(asyncio.ensure_future((make_hedge or make_call)(asyncio.Event())))
+
+            fallback = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is not None:
+                        continue
+                    if is_valid(task.result()):
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    if fallback is None:
+                        fallback = task
+            if fallback is not None:
+                return fallback.result()
+            raise first.exception()
+        finally:
+            for task in tasks + ([waiting] if waiting else []):
+                task.cancel()
+            self.batch_seconds.append(time.monotonic() - started)
+
+    def summary(self):
+        if not self.batch_seconds:
+            return "no Gemini calls"
+        return (
+            f"{self.calls} calls, {self.hedges} hedged ({self.hedge_wins} won by the hedge), "
+            f"latency p50 {percentile(self.batch_seconds, 0.5):.2f}s / p95 {percentile(self.batch_seconds, 0.95):.2f}s / "
+            f"p99 {percentile(self.batch_seconds, 0.99):.2f}s"
+        )
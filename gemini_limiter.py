@@ -0,0 +1,129 @@
+import os
+import time
+import random
+import asyncio
+import threading
+
+# Gemini quota of one API key, shared by every user's analysis on this server (see gemini_pool).
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+# Gemini batches one analysis may have in flight at once.
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 60.0
+# Rate scale floor and per-success recovery step for the adaptive (AIMD) backoff.
+MIN_SCALE = 0.1
+RECOVERY_STEP = 0.05
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 UTF-8 bytes per token); good enough for rate limiting."""
+    return len((text or "").encode("utf-8")) // 4 + 1
+
+
+class GeminiRateLimiter:
+    """
+    Token buckets for requests/minute and tokens/minute. Waiters are served in arrival order
+    (asyncio.Lock is FIFO), so users share the quota fairly. A 429 halves the effective rate and
+    pauses every caller for a jittered backoff; each success slowly restores the rate.
+    """
+
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.scale = 1.0
+        self.request_budget = rpm
+        self.token_budget = tpm
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0
+        self.rate_limited = 0
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm * self.scale / 60)
+        self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm * self.scale / 60)
+
+    def headroom(self):
+        """Share of the per-minute budget available right now (negative while cooling down or queued)."""
+        now = time.monotonic()
+        if now < self.cooldown_until:
+            return now - self.cooldown_until
+        self._refill(now)
+        return min(self.request_budget / self.rpm, self.token_budget / self.tpm) * self.scale - self.waiting / self.rpm
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tpm)
+        self.waiting += 1
+        try:
+            await self._acquire(tokens)
+        finally:
+            self.waiting -= 1
+
+    async def _acquire(self, tokens):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.cooldown_until:
+                    await asyncio.sleep(self.cooldown_until - now)
+                    continue
+                self._refill(now)
+                if self.request_budget >= 1 and self.token_budget >= tokens:
+                    self.request_budget -= 1
+                    self.token_budget -= tokens
+                    return
+                wait = max(
+                    (1 - self.request_budget) * 60 / (self.rpm * self.scale),
+                    (tokens - self.token_budget) * 60 / (self.tpm * self.scale),
+                )
+                await asyncio.sleep(max(wait, 0.01))
+
+    def on_rate_limited(self, attempt):
+        self.rate_limited += 1
+        self.scale = max(MIN_SCALE, self.scale / 2)
+        delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + delay)
+
+    def on_success(self):
+        self.scale = min(1.0, self.scale + RECOVERY_STEP)
+
+
+class UsageStats:
+    """Per-tier call count, latency and token usage of Gemini requests (thread-safe; calls run on the I/O pool)."""
+
+    def __init__(self):
+        self.tiers = {}
+        self._lock = threading.Lock()
+
+    def record(self, tier, seconds, response=None):
+        usage = getattr(response, "usage_metadata", None)
+        with self._lock:
+            stats = self.tiers.setdefault(tier, {"calls": 0, "emails": 0, "seconds": [], "input_tokens": 0, "output_tokens": 0})
+            stats["calls"] += 1
+            stats["seconds"].append(seconds)
+            if usage is not None:
+                stats["input_tokens"] += usage.prompt_token_count or 0
+                stats["output_tokens"] += usage.candidates_token_count or 0
+
+    def add_emails(self, tier, count):
+        with self._lock:
+            self.tiers.setdefault(tier, {"calls": 0, "emails": 0, "seconds": [], "input_tokens": 0, "output_tokens": 0})["emails"] += count
+
+    def summary(self):
+        lines = []
+        with self._lock:
+            for tier, stats in self.tiers.items():
+                if not stats["calls"]:
+                    continue
+                seconds = sorted(stats["seconds"])
+                lines.append(
+                    f"{tier}: {stats['calls']} calls, {stats['emails']} emails, "
+                    f"p50 {seconds[len(seconds) // 2]:.2f}s / max {seconds[-1]:.2f}s, "
+                    f"{stats['input_tokens']} input + {stats['output_tokens']} output tokens"
+                )
+        return "; ".join(lines) or "no Gemini calls"
+
@@ -0,0 +1,90 @@
+import os
+import threading
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+from gemini_limiter import GeminiRateLimiter
+
+# Extra API keys (comma-separated) to spread Gemini load over; each has its own RPM/TPM quota.
+GEMINI_API_KEYS = [key.strip() for key in os.getenv("GEMINI_API_KEYS", "").split(",") if key.strip()]
+
+
+class GeminiClientPool:
+    """
+    One long-lived GenerativeService client (and its gRPC channel) per API key, plus cached
+    GenerativeModel objects bound to it, so batches neither reconfigure the global genai client
+    nor reconnect. Each key gets its own GeminiRateLimiter, and acquire() routes a request to the
+    key with the most headroom left.
+
+    model() is safe to call from the I/O pool threads; acquire() and the on_* callbacks run on
+    the event loop.
+    """
+
+    def __init__(self, api_keys=()):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._models = {}
+        self.limiters = {}
+        self.calls = {}
+        for api_key in api_keys:
+            self.add_key(api_key)
+
+    def add_key(self, api_key):
+        with self._lock:
+            if api_key and api_key not in self.limiters:
+                self.limiters[api_key] = GeminiRateLimiter()
+                self.calls[api_key] = 0
+
+    def _client(self, api_key):
+        client = self._clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            self._clients[api_key] = client
+        return client
+
+    def model(self, api_key, model_name, json_mode=False):
+        """A GenerativeModel for `model_name` that sends through `api_key`'s shared client."""
+        with self._lock:
+            model = self._models.get((api_key, model_name, json_mode))
+            if model is None:
+                config = {"response_mime_type": "application/json"} if json_mode else None
+                model = genai.GenerativeModel(model_name, generation_config=config)
+                # GenerativeModel falls back to the global default client only when none is set
+                model._client = self._client(api_key)
+                self._models[(api_key, model_name, json_mode)] = model
+            return model
+
+    async def acquire(self, tokens):
+        """Waits for quota on the key with the most headroom and returns that key."""
+        if not self.limiters:
+            raise RuntimeError("No Gemini API key configured")
+        api_key = max(self.limiters, key=lambda key: self.limiters[key].headroom())
+        await self.limiters[api_key].acquire(tokens)
+        self.calls[api_key] += 1
+        return api_key
+
+    def on_rate_limited(self, api_key, attempt):
+        self.limiters[api_key].on_rate_limited(attempt)
+
+    def on_success(self, api_key):
+        self.limiters[api_key].on_success()
+
+    def summary(self):
+        return "; ".join(
+            f"key …{api_key[-4:]}: {self.calls[api_key]} calls, {limiter.rate_limited} rate limited, rate x{limiter.scale:.2f}"
+            for api_key, limiter in self.limiters.items()
+        )
+
+
+_default_pool = None
+_default_lock = threading.Lock()
+
+
+def get_gemini_pool():
+    """Process-wide client pool, seeded with GEMINI_API_KEYS on first use."""
+    global _default_pool
+    with _default_lock:
+        if _default_pool is None:
+            _default_pool = GeminiClientPool(GEMINI_API_KEYS)
+        return _default_pool
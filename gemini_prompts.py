@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import hashlib
+
+from batch_packer import COMPACT_OUTPUT_TOKENS_PER_ITEM, OUTPUT_TOKENS_PER_ITEM, prompt_line
+from gemini_limiter import estimate_tokens
+from gemini_response import coerce_id, expand_rows, parse_json_array
+
+BATCH_PROMPT = """
+You are an analyzer that extracts 'subscription/recurring payment/newsletter/membership' information from emails.
+A list of multiple emails will be given as input.
+Each email is represented as a single line of JSON, in the format:
+{"id": 1, "subject": "...", "sender": "...", "body": "..."}
+
+Your tasks:
+1) Determine if each email is related to a subscription/recurring payment/newsletter/membership.
+2) Convert only the relevant ones into a JSON object with the format below.
+3) Finally, output only a JSON array (No explanations, no code blocks).
+
+Format:
+[
+  {
+    "id": 1,
+    "is_subscription": true,
+    "service_name": "Service or brand name",
+    "plan_name": "Plan name or null",
+    "price": "Price as a string or null",
+    "currency": "KRW, USD, etc., or null",
+    "billing_cycle": "monthly / yearly / weekly / once / unknown",
+    "start_date": "YYYY-MM-DD format or null",
+    "next_billing_date": "YYYY-MM-DD format or null"
+  },
+  ...
+]
+
+If an email is completely unrelated to subscriptions/recurring payments, exclude it from the array entirely.
+If there are no related emails, output an empty array [].
+"""
+
+COMPACT_BATCH_PROMPT = """
+You are an analyzer that extracts 'subscription/recurring payment/newsletter/membership' information from emails.
+A list of multiple emails will be given as input.
+Each email is represented as a single line of JSON, in the format:
+{"id": 1, "subject": "...", "sender": "...", "body": "..."}
+
+Output one JSON array row per email related to a subscription/recurring payment/newsletter/membership,
+with the values in exactly this order and no keys:
+[id, service_name, plan_name, price, currency, billing_cycle, start_date, next_billing_date]
+
+- price is a string, currency is KRW, USD, etc.; use null for anything unknown.
+- billing_cycle is one letter: m (monthly), y (yearly), w (weekly), o (once), u (unknown).
+- Dates are YYYY-MM-DD.
+
+Example: [[1, "Netflix", "Premium", "17000", "KRW", "m", null, "2025-01-05"]]
+Leave unrelated emails out. If there are none, output [].
+"""
+# Field order of a COMPACT_BATCH_PROMPT row.
+COMPACT_FIELDS = ("id", "service_name", "plan_name", "price", "currency", "billing_cycle", "start_date", "next_billing_date")
+
+TRIAGE_PROMPT = """
+You screen emails for a subscription tracker.
+Each email is one line of JSON: {"id": 1, "subject": "...", "sender": "...", "body": "..."}
+Output only a JSON array with the ids of the emails about a subscription/recurring payment/newsletter/membership, e.g. [1, 4].
+If there are none, output [].
+"""
+
+# Model for the full extraction prompt
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash-lite")
+# Two-tier cascade: a yes/no screen on the cheapest model over large batches, full extraction only for its positives
+GEMINI_CASCADE = os.getenv("GEMINI_CASCADE", "1") != "0"
+GEMINI_TRIAGE_MODEL = os.getenv("GEMINI_TRIAGE_MODEL", "gemini-2.0-flash-lite")
+# The screen only needs the gist of each email, and answers with little more than its id
+TRIAGE_ITEM_TOKENS = int(os.getenv("GEMINI_TRIAGE_ITEM_TOKENS", "300"))
+TRIAGE_OUTPUT_TOKENS_PER_ITEM = 3
+# Ask for positional rows (in Gemini's JSON mode) instead of keyed objects; output tokens dominate latency and cost
+GEMINI_COMPACT_OUTPUT = os.getenv("GEMINI_COMPACT_OUTPUT", "1") != "0"
+# Bump the tag on intentional prompt changes; the hash also catches accidental edits.
+# Cached extractions from any other version are ignored and purged.
+# With the cascade on, the screen's verdicts are cached too, so its prompt and model are part of the version.
+BATCH_PROMPT_VERSION = "v1-" + hashlib.sha256(
+    ((COMPACT_BATCH_PROMPT if GEMINI_COMPACT_OUTPUT else BATCH_PROMPT)
+     + (f"{GEMINI_TRIAGE_MODEL}\n{TRIAGE_PROMPT}" if GEMINI_CASCADE else "")).encode("utf-8")
+).hexdigest()[:8]
+
+
+def build_batch_prompt(email_items, compact=GEMINI_COMPACT_OUTPUT):
+    # Bodies are cut to the packer's per-item token cap
+    joined = "\n".join(prompt_line(item) for item in email_items)
+    return (COMPACT_BATCH_PROMPT if compact else BATCH_PROMPT) + "\n\n### Email List\n" + joined
+
+
+def estimate_batch_tokens(email_items, compact=GEMINI_COMPACT_OUTPUT):
+    """Input plus expected output tokens of one batch request."""
+    per_item = COMPACT_OUTPUT_TOKENS_PER_ITEM if compact else OUTPUT_TOKENS_PER_ITEM
+    return estimate_tokens(build_batch_prompt(email_items, compact)) + per_item * len(email_items)
+
+
+def build_triage_prompt(email_items):
+    joined = "\n".join(prompt_line(item, TRIAGE_ITEM_TOKENS) for item in email_items)
+    return TRIAGE_PROMPT + "\n\n### Email List\n" + joined
+
+
+def estimate_triage_tokens(email_items):
+    return estimate_tokens(build_triage_prompt(email_items)) + TRIAGE_OUTPUT_TOKENS_PER_ITEM * len(email_items)
+
+
+def decode_batch_response(text, email_items, compact=GEMINI_COMPACT_OUTPUT):
+    """
+    Turns the text of a batch answer into (result, missing): `result` maps id -> extraction for
+    the subscription emails answered, `missing` is the set of ids whose answer was lost to a
+    malformed response. Complete objects are salvaged from a broken JSON array, but since unrelated
+    emails are left out of the array, every id without an object counts as missing once the array
+    is damaged. An element that had to be dropped (wrong type or row length, no usable id, an id
+    not in the batch) damages the array too, since there is no telling whose answer it was.
+    With compact=True the positional rows are expanded back into the same field dicts.
+    """
+    all_ids = {item["id"] for item in email_items}
+    if compact:
+        elements, complete = parse_json_array(text, element_type=list)
+        expanded = expand_rows(elements, COMPACT_FIELDS)
+    else:
+        elements, complete = parse_json_array(text)
+        expanded = {}
+        for obj in elements:
+            _id = coerce_id(obj.get("id"))
+            if _id is not None:
+                expanded[_id] = {**obj, "id": _id}
+    answered = {_id: obj for _id, obj in expanded.items() if _id in all_ids}
+
+    result = {_id: obj for _id, obj in answered.items() if obj.get("is_subscription")}
+    if complete and len(answered) == len(elements):
+        return result, set()
+    print(f"Malformed Gemini response: salvaged {len(answered)} of {len(email_items)} emails.")
+    return result, all_ids - answered.keys()
+
+
+def _synthetic_batch(size, offset=0):
+    services = [("Netflix", "Premium", "17,000원"), ("Spotify", "Duo", "$14.99"), ("Notion", "Plus", "$10.00"), ("Coupang", None, "4,990원")]
+    items = []
+    for i in range(size):
+        name, plan, price = services[(offset + i) % len(services)]
+        if i % 3 == 2:
+            subject, body = "Weekly digest", "Here are this week's top stories from our community. " * 20
+        else:
+            subject = f"Your {name} receipt"
+            body = f"Thanks for your payment. Plan: {plan or 'Standard'}. Amount charged: {price}. Next billing date: 2025-0{1 + i % 9}-15. " * 3
+        items.append({"id": offset + i, "subject": subject, "sender": f"{name} <billing@{name.lower()}.com>", "body": body})
+    return items
+
+
+def _benchmark(batches=3, batch_size=20):
+    """
+    Compares the verbose and compact response formats: estimated output tokens of the same
+    extractions offline, then (with GEMINI_API_KEY set) real output tokens and latency per batch.
+    """
+    sample = [
+        {"id": i, "is_subscription": True, "service_name": "Netflix", "plan_name": "Premium", "price": "17000",
+         "currency": "KRW", "billing_cycle": "monthly", "start_date": None, "next_billing_date": "2025-01-05"}
+        for i in range(batch_size)
+    ]
+    codes = {"monthly": "m"}
+    rows = [[obj[field] if field != "billing_cycle" else codes[obj[field]] for field in COMPACT_FIELDS] for obj in sample]
+    verbose_tokens = estimate_tokens(json.dumps(sample, ensure_ascii=False, indent=2))
+    compact_tokens = estimate_tokens(json.dumps(rows, ensure_ascii=False))
+    assert expand_rows(rows, COMPACT_FIELDS) == {obj["id"]: obj for obj in sample}
+    print(f"Estimated output for {batch_size} extractions: verbose {verbose_tokens} tokens, compact {compact_tokens} tokens "
+          f"({compact_tokens / verbose_tokens:.0%}).")
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("Set GEMINI_API_KEY to measure real output tokens and latency.")
+        return
+    from gemini_pool import get_gemini_pool
+
+    for compact in (False, True):
+        model = get_gemini_pool().model(api_key, GEMINI_MODEL_NAME, json_mode=compact)
+        latencies, output_tokens, extracted = [], [], 0
+        for n in range(batches):
+            items = _synthetic_batch(batch_size, offset=n * batch_size)
+            started = time.perf_counter()
+            resp = model.generate_content(build_batch_prompt(items, compact))
+            latencies.append(time.perf_counter() - started)
+            output_tokens.append(resp.usage_metadata.candidates_token_count)
+            if compact:
+                extracted += len(expand_rows(parse_json_array(resp.text, element_type=list)[0], COMPACT_FIELDS))
+            else:
+                extracted += sum(1 for obj in parse_json_array(resp.text)[0] if obj.get("is_subscription"))
+        print(f"{'compact' if compact else 'verbose':<8} avg {sum(output_tokens) / batches:>6.0f} output tokens/batch, "
+              f"avg {sum(latencies) / batches:>5.2f}s/batch, {extracted} extractions")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,93 @@
+import json
+
+_decoder = json.JSONDecoder()
+
+# One-letter codes the compact prompts use for enum fields.
+COMPACT_CODES = {
+    "billing_cycle": {"m": "monthly", "y": "yearly", "w": "weekly", "o": "once", "u": "unknown"},
+}
+
+
+def strip_code_fence(text):
+    """Drops the ```json ... ``` wrapper Gemini sometimes puts around its answer."""
+    text = (text or "").strip().strip("`").strip()
+    if text.lower().startswith("json"):
+        text = text[4:].strip()
+    return text
+
+
+def coerce_id(value):
+    """An email id as the int the prompt gave it; models sometimes echo it as "3" or 3.0. None if unusable."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+
+def parse_json_array(text, element_type=dict):
+    """
+    Parses a JSON array of objects (or, with element_type=list, of positional rows) element by
+    element, keeping every element that decodes even if the array is truncated or an element in
+    the middle is malformed.
+
+    Returns (objects, complete): `complete` is True only when the whole text was a well-formed
+    array of `element_type` elements, i.e. when nothing can have been lost.
+    """
+    text = strip_code_fence(text)
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    else:
+        if isinstance(parsed, list):
+            objects = [obj for obj in parsed if isinstance(obj, element_type)]
+            # e.g. keyed objects where rows were asked for: those answers are lost, not empty
+            return objects, len(objects) == len(parsed)
+        return [], False
+
+    start = text.find("[")
+    if start < 0:
+        return [], False
+    objects = []
+    pos = start + 1
+    while True:
+        # Skip separators between elements
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            return objects, False
+        try:
+            value, pos = _decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            # Resync on the next element start; a broken element costs only itself
+            pos = text.find("{" if element_type is dict else "[", pos + 1)
+            if pos < 0:
+                return objects, False
+            continue
+        if isinstance(value, element_type):
+            objects.append(value)
+
+
+def expand_rows(rows, fields):
+    """
+    Expands compact positional rows (`fields[0]` is the id) back into the field dicts the verbose
+    prompt returns. Only subscription emails get a row, so every expanded dict has is_subscription.
+    Returns {id: fields}; numeric-string ids are coerced to int, and rows of the wrong length or
+    without a usable id are dropped (callers compare the count against `rows` to notice).
+    """
+    result = {}
+    for row in rows:
+        _id = coerce_id(row[0]) if row else None
+        if len(row) != len(fields) or _id is None:
+            continue
+        obj = {"id": _id, "is_subscription": True}
+        for field, value in zip(fields[1:], row[1:]):
+            codes = COMPACT_CODES.get(field)
+            obj[field] = codes.get(value, value) if codes and isinstance(value, str) else value
+        result[_id] = obj
+    return result
@@ -0,0 +1,147 @@
+import os
+import time
+import datetime as dt
+from googleapiclient.errors import HttpError
+
+from blocking_io import run_blocking
+from gmail_quota import GMAIL_MAX_RETRIES, QUOTA_COSTS, backoff_delay, execute, is_retryable, limiter
+
+# How far back a full sync looks, and an optional cap on listed messages (0 = no cap).
+GMAIL_HORIZON_DAYS = int(os.getenv("GMAIL_HORIZON_DAYS", "180"))
+GMAIL_MAX_MESSAGES = int(os.getenv("GMAIL_MAX_MESSAGES", "0")) or None
+# messages.list returns at most 500 ids per page.
+GMAIL_LIST_PAGE_SIZE = 500
+
+# Gmail's batch endpoint accepts up to 100 calls, but recommends <= 50 to avoid rate limiting.
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+
+
+def fetch_messages_batched(service, message_ids, format="full", batch_size=GMAIL_BATCH_SIZE, user_key=None, **get_kwargs):
+    """
+    Fetches messages through Gmail's batch HTTP endpoint (one round trip per `batch_size` ids).
+
+    Every batch is charged against the quota limiter (5 units per message). Items that fail with
+    429/5xx are re-batched and retried with jittered exponential backoff.
+
+    Returns (details, errors): both dicts keyed by message id. A failing item lands in
+    `errors` and does not abort the rest of the batch.
+    """
+    return _fetch_batched(
+        service, message_ids, service.users().messages(), "messages.get", batch_size, user_key,
+        format=format, **get_kwargs,
+    )
+
+
+def fetch_threads_batched(service, thread_ids, format="metadata", batch_size=GMAIL_BATCH_SIZE, user_key=None, **get_kwargs):
+    """Same as fetch_messages_batched for users.threads.get (10 quota units per thread)."""
+    return _fetch_batched(
+        service, thread_ids, service.users().threads(), "threads.get", batch_size, user_key,
+        format=format, **get_kwargs,
+    )
+
+
+def _fetch_batched(service, ids, collection, method, batch_size, user_key, **get_kwargs):
+    batch_size = max(1, min(int(batch_size), 100))
+    details = {}
+    errors = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            details[request_id] = response
+
+    # request_id must be unique within a batch
+    pending = list(dict.fromkeys(ids))
+    for attempt in range(GMAIL_MAX_RETRIES + 1):
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=on_response)
+            for item_id in chunk:
+                batch.add(collection.get(userId="me", id=item_id, **get_kwargs), request_id=item_id)
+            limiter.acquire(user_key, QUOTA_COSTS[method] * len(chunk))
+            try:
+                batch.execute()
+            except HttpError as e:
+                if not is_retryable(e):
+                    raise
+                for item_id in chunk:
+                    errors[item_id] = e
+
+        pending = [item_id for item_id, err in errors.items() if is_retryable(err)]
+        if not pending or attempt == GMAIL_MAX_RETRIES:
+            break
+        for item_id in pending:
+            del errors[item_id]
+        time.sleep(backoff_delay(attempt))
+
+    return details, errors
+
+
+# Labels the full-sync query excludes (-category:promotions -category:social); history results are filtered the same way.
+EXCLUDED_LABELS = {"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL"}
+
+
+def list_history_message_ids(service, start_history_id, user_key=None):
+    """
+    Lists ids of messages added since `start_history_id` via users.history.list.
+
+    Returns None when Gmail no longer has history that far back (HTTP 404), in which
+    case the caller must fall back to a full resync.
+    """
+    message_ids = []
+    request = service.users().history().list(
+        userId="me", startHistoryId=start_history_id, historyTypes=["messageAdded"], maxResults=500
+    )
+    while request is not None:
+        try:
+            response = execute(user_key, request, "history.list")
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added.get("message", {})
+                if EXCLUDED_LABELS.intersection(message.get("labelIds", [])):
+                    continue
+                message_ids.append(message["id"])
+        request = service.users().history().list_next(request, response)
+    return list(dict.fromkeys(message_ids))
+
+
+def build_sync_query(horizon_days=GMAIL_HORIZON_DAYS):
+    after = (dt.date.today() - dt.timedelta(days=horizon_days)).strftime("%Y/%m/%d")
+    return f"-category:promotions -category:social in:anywhere after:{after}"
+
+
+def iter_message_id_pages(service, query, max_messages=GMAIL_MAX_MESSAGES, page_size=GMAIL_LIST_PAGE_SIZE, user_key=None, threads=False):
+    """
+    Yields message ids page by page, following nextPageToken until the mailbox or
+    `max_messages` (None = unbounded) is exhausted. With threads=True, lists thread ids instead.
+    """
+    kind = "threads" if threads else "messages"
+    collection = service.users().threads() if threads else service.users().messages()
+    remaining = max_messages
+    request = collection.list(userId="me", q=query, maxResults=page_size)
+    while request is not None:
+        response = execute(user_key, request, f"{kind}.list")
+        ids = [item["id"] for item in response.get(kind, [])]
+        if remaining is not None:
+            ids = ids[:remaining]
+            remaining -= len(ids)
+        if ids:
+            yield ids
+        if remaining == 0:
+            return
+        request = collection.list_next(request, response)
+
+
+async def aiter_message_id_pages(service, user_id, query, max_messages=GMAIL_MAX_MESSAGES, page_size=GMAIL_LIST_PAGE_SIZE, threads=False):
+    """Async version of iter_message_id_pages; each page is requested on the shared I/O pool only when consumed."""
+    pages = iter_message_id_pages(service, query, max_messages, page_size, user_key=user_id, threads=threads)
+    while True:
+        page = await run_blocking(user_id, next, pages, None)
+        if page is None:
+            return
+        yield page
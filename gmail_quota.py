@@ -0,0 +1,111 @@
+import os
+import time
+import random
+import threading
+
+from googleapiclient.errors import HttpError
+
+# Gmail quota units per method (https://developers.google.com/gmail/api/reference/quota).
+QUOTA_COSTS = {
+    "messages.get": 5,
+    "messages.list": 5,
+    "history.list": 2,
+    "getProfile": 1,
+    "threads.get": 10,
+    "threads.list": 10,
+}
+
+# Per-user limit is 250 units/second; the per-project limit is shared by every user in the process.
+GMAIL_USER_UNITS_PER_SEC = float(os.getenv("GMAIL_USER_UNITS_PER_SEC", "250"))
+GMAIL_PROJECT_UNITS_PER_SEC = float(os.getenv("GMAIL_PROJECT_UNITS_PER_SEC", "20000"))
+
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 32.0
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks the calling (pool) thread until enough tokens are available."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount):
+        # A request bigger than the bucket (e.g. a full batch) is allowed once the bucket is full
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GmailQuotaLimiter:
+    """Charges each call against the caller's per-user bucket and the process-wide project bucket."""
+
+    def __init__(self, user_rate=GMAIL_USER_UNITS_PER_SEC, project_rate=GMAIL_PROJECT_UNITS_PER_SEC):
+        self.user_rate = user_rate
+        self.project = TokenBucket(project_rate)
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def _user_bucket(self, user_key):
+        with self.lock:
+            bucket = self.users.get(user_key)
+            if bucket is None:
+                bucket = self.users[user_key] = TokenBucket(self.user_rate)
+            return bucket
+
+    def acquire(self, user_key, units):
+        self._user_bucket(user_key).acquire(units)
+        self.project.acquire(units)
+
+
+limiter = GmailQuotaLimiter()
+
+
+def is_retryable(error):
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    # Gmail reports some rate limiting as 403 with a rate-limit reason
+    return status == 403 and any(
+        detail.get("reason") in RATE_LIMIT_REASONS for detail in (error.error_details or []) if isinstance(detail, dict)
+    )
+
+
+def is_not_found(error):
+    """A 404: the message/thread was deleted since it was listed and will never be fetchable."""
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def execute(user_key, request, method, max_retries=GMAIL_MAX_RETRIES):
+    """Executes one Gmail request under the quota limiter, retrying 429/5xx with jittered backoff."""
+    units = QUOTA_COSTS.get(method, 5)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(user_key, units)
+        try:
+            return request.execute()
+        except HttpError as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            time.sleep(backoff_delay(attempt))
@@ -1,59 +1,19 @@
 from __future__ import print_function
 import os.path
-import base64
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
+from mail_text import get_plain_text_from_message
+from message_cache import get_message_cache
+
 # Gmail 읽기 전용 권한
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
-
-def get_plain_text_from_message(msg_detail):
-    """
-    MIME 구조에서 텍스트 본문만 깔끔하게 뽑아내는 헬퍼 함수
-    """
-    payload = msg_detail.get("payload", {})
-    mime_type = payload.get("mimeType", "")
-    body = payload.get("body", {})
-    parts = payload.get("parts", [])
-
-    # 1) 메일이 text/plain 한 덩어리일 때
-    if mime_type == "text/plain" and "data" in body:
-        data = body["data"]
-        return base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-
-    # 2) multipart/alternative, multipart/mixed 등 파트가 나뉜 메일일 때
-    text_parts = []
-
-    def walk_parts(parts_list):
-        for part in parts_list:
-            part_mime = part.get("mimeType", "")
-            part_body = part.get("body", {})
-            sub_parts = part.get("parts", [])
-
-            # 다시 하위 파트 있으면 재귀
-            if sub_parts:
-                walk_parts(sub_parts)
-
-            # text/plain 파트만 모으기
-            if part_mime == "text/plain" and "data" in part_body:
-                data = part_body["data"]
-                text = base64.urlsafe_b64decode(data).decode(
-                    "utf-8", errors="ignore"
-                )
-                text_parts.append(text)
-
-    if parts:
-        walk_parts(parts)
-
-    if text_parts:
-        return "\n".join(text_parts)
-
-    # 3) 못 찾으면 빈 문자열
-    return ""
+# 로컬 캐시에서 token.json 사용자를 구분하는 키
+CACHE_USER_KEY = "local"
 
 
 def main():
@@ -94,25 +54,42 @@ def main():
 
     print("최근 메일 5개:")
 
+    # 이미 받아둔 메일은 로컬 캐시에서 바로 꺼내기 (Gmail 메일은 바뀌지 않음)
+    cache = get_message_cache()
+    cached = cache.get_many(CACHE_USER_KEY, [msg["id"] for msg in messages])
+
     for msg in messages:
-        msg_detail = (
-            service.users()
-            .messages()
-            .get(userId="me", id=msg["id"], format="full")
-            .execute()
-        )
-
-        headers = msg_detail["payload"]["headers"]
-        subject = next(
-            (h["value"] for h in headers if h["name"] == "Subject"),
-            "(제목 없음)",
-        )
-        from_addr = next(
-            (h["value"] for h in headers if h["name"] == "From"),
-            "(발신자 없음)",
-        )
-
-        body_text = get_plain_text_from_message(msg_detail)
+        record = cached.get(msg["id"])
+
+        if record is None:
+            msg_detail = (
+                service.users()
+                .messages()
+                .get(userId="me", id=msg["id"], format="full")
+                .execute()
+            )
+
+            headers = msg_detail["payload"]["headers"]
+            record = {
+                "subject": next(
+                    (h["value"] for h in headers if h["name"] == "Subject"),
+                    "(제목 없음)",
+                ),
+                "sender": next(
+                    (h["value"] for h in headers if h["name"] == "From"),
+                    "(발신자 없음)",
+                ),
+                "date": next(
+                    (h["value"] for h in headers if h["name"] == "Date"),
+                    "",
+                ),
+                "body": get_plain_text_from_message(msg_detail),
+            }
+            cache.put(CACHE_USER_KEY, msg["id"], record)
+
+        subject = record["subject"]
+        from_addr = record["sender"]
+        body_text = record["body"]
 
         print("=" * 60)
         print("제목 :", subject)
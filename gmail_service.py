@@ -0,0 +1,84 @@
+import json
+import threading
+
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+# Per-request socket timeout for Gmail calls (seconds).
+GMAIL_HTTP_TIMEOUT = 60
+
+# Parsed once per process from the discovery document bundled with google-api-python-client,
+# so building a service never touches the network or re-parses the JSON.
+_discovery_doc = json.loads(get_static_doc("gmail", "v1"))
+
+_thread_local = threading.local()
+_services = {}
+_services_lock = threading.Lock()
+
+
+def _thread_http():
+    # httplib2.Http keeps connections alive but is not thread-safe, so each pool thread owns one.
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = _thread_local.http = httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT)
+    return http
+
+
+class _PooledAuthorizedHttp:
+    """
+    Stands in for the service's http object: authorizes with one user's credentials but sends
+    through the calling thread's keep-alive connection, so one cached service can be used from
+    any thread of the I/O pool.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def request(self, *args, **kwargs):
+        return AuthorizedHttp(self.credentials, http=_thread_http()).request(*args, **kwargs)
+
+    def close(self):
+        pass
+
+
+def credentials_from_row(db_creds):
+    """Builds google Credentials from a GoogleCredentials row."""
+    return Credentials(
+        token=db_creds.token, refresh_token=db_creds.refresh_token,
+        token_uri=db_creds.token_uri, client_id=db_creds.client_id,
+        client_secret=db_creds.client_secret, scopes=db_creds.scopes,
+        expiry=db_creds.expiry,
+    )
+
+
+def get_gmail_service(user_id, db_creds):
+    """
+    Returns (service, credentials) for a user, reusing the process-wide instance while the stored
+    refresh token is unchanged. The credentials object is shared, so a token refreshed by one
+    analysis is reused by the next instead of being refreshed again.
+    """
+    with _services_lock:
+        entry = _services.get(user_id)
+        if entry is None or entry[0] != db_creds.refresh_token:
+            credentials = credentials_from_row(db_creds)
+            service = build_from_document(_discovery_doc, http=_PooledAuthorizedHttp(credentials))
+            entry = _services[user_id] = (db_creds.refresh_token, service, credentials)
+        return entry[1], entry[2]
+
+
+def forget_user(user_id):
+    """Drops a user's cached service, e.g. after they re-link their Google account."""
+    with _services_lock:
+        _services.pop(user_id, None)
+
+
+def store_refreshed_token(db_creds, credentials):
+    """Writes a refreshed access token back to the GoogleCredentials row. Returns True if it changed."""
+    if credentials.token and credentials.token != db_creds.token:
+        db_creds.token = credentials.token
+        db_creds.expiry = credentials.expiry
+        return True
+    return False
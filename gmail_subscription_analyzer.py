@@ -1,6 +1,5 @@
 from __future__ import print_function
 import os.path
-import base64
 import json
 
 from google.auth.transport.requests import Request
@@ -11,6 +10,10 @@ from googleapiclient.discovery import build
 import google.generativeai as genai
 import pandas as pd
 
+from gmail_fetch import iter_message_id_pages
+from mail_text import get_plain_text_from_message
+from message_cache import get_message_cache
+
 # ---------------------------------------------------
 #  설정
 # ---------------------------------------------------
@@ -24,9 +27,13 @@ load_dotenv()
 # Gmail 읽기 전용 권한
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
-# 최근 6개월 기준 (gmail 검색쿼리용)
-NEWER_THAN_DAYS = 180      # 6개월 ≈ 180일
-MAX_EMAILS = 300           # 너무 많으면 상한선
+# 로컬 메일 캐시에서 token.json 사용자를 구분하는 키
+CACHE_USER_KEY = "local"
+
+# 최근 6개월 기준 (gmail 검색쿼리용, 환경 변수로 조정 가능)
+NEWER_THAN_DAYS = int(os.getenv("GMAIL_HORIZON_DAYS", "180"))      # 6개월 ≈ 180일
+MAX_EMAILS = int(os.getenv("GMAIL_MAX_MESSAGES", "300")) or None   # 너무 많으면 상한선 (0 = 제한 없음)
+ANALYZER_BODY_CHARS = 4000                                          # Gemini에 보낼 본문 글자 수
 
 # ✅ Gemini API 키 (환경 변수에서 가져오기)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -42,54 +49,6 @@ else:
 
 model = genai.GenerativeModel(MODEL_NAME)
 
-# ---------------------------------------------------
-#  이메일 본문 파싱 함수
-# ---------------------------------------------------
-def get_plain_text_from_message(msg_detail):
-    """
-    MIME 구조에서 텍스트 본문만 깔끔하게 뽑아내는 함수
-    """
-    payload = msg_detail.get("payload", {})
-    mime_type = payload.get("mimeType", "")
-    body = payload.get("body", {})
-    parts = payload.get("parts", [])
-
-    # 1) 메일이 text/plain 한 덩어리일 때
-    if mime_type == "text/plain" and "data" in body:
-        data = body["data"]
-        return base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-
-    # 2) multipart/alternative, multipart/mixed 등 파트가 나뉜 메일일 때
-    text_parts = []
-
-    def walk_parts(parts_list):
-        for part in parts_list:
-            part_mime = part.get("mimeType", "")
-            part_body = part.get("body", {})
-            sub_parts = part.get("parts", [])
-
-            # 다시 하위 파트 있으면 재귀
-            if sub_parts:
-                walk_parts(sub_parts)
-
-            # text/plain 파트만 모으기
-            if part_mime == "text/plain" and "data" in part_body:
-                data = part_body["data"]
-                text = base64.urlsafe_b64decode(data).decode(
-                    "utf-8", errors="ignore"
-                )
-                text_parts.append(text)
-
-    if parts:
-        walk_parts(parts)
-
-    if text_parts:
-        return "\n".join(text_parts)
-
-    # 3) 못 찾으면 빈 문자열
-    return ""
-
-
 # ---------------------------------------------------
 #  Gemini 프롬프트 (구독/정기결제/뉴스레터 분석)
 # ---------------------------------------------------
@@ -193,27 +152,14 @@ def get_gmail_service():
 def fetch_recent_messages(service):
     """
     Gmail API로 최근 NEWER_THAN_DAYS 일 메일 ID들 가져오기
+    (nextPageToken 따라가며 페이지 단위로 가져오고, MAX_EMAILS 에서 멈춤)
     """
     q = f"newer_than:{NEWER_THAN_DAYS}d"
-    messages = []
-
-    request = service.users().messages().list(
-        userId="me",
-        q=q,
-        maxResults=100,
-    )
-
-    while request is not None:
-        response = request.execute()
-        batch = response.get("messages", [])
-        messages.extend(batch)
-
-        if len(messages) >= MAX_EMAILS:
-            break
-
-        request = service.users().messages().list_next(request, response)
-
-    return messages[:MAX_EMAILS]
+    return [
+        {"id": msg_id}
+        for page in iter_message_id_pages(service, q, max_messages=MAX_EMAILS, page_size=100)
+        for msg_id in page
+    ]
 
 import time
 # ---------------------------------------------------
@@ -237,32 +183,47 @@ def main():
 
     rows = []
 
+    # 이미 받아둔 메일은 로컬 캐시에서 꺼내고, 없는 것만 API 호출
+    cache = get_message_cache()
+    cached = cache.get_many(CACHE_USER_KEY, [msg["id"] for msg in msg_list])
+    print(f"캐시 적중: {len(cached)}/{len(msg_list)}")
+
     for idx, msg in enumerate(msg_list, start=1):
         msg_id = msg["id"]
+        record = cached.get(msg_id)
+
+        if record is None:
+            msg_detail = (
+                service.users()
+                .messages()
+                .get(userId="me", id=msg_id, format="full")
+                .execute()
+            )
 
-        msg_detail = (
-            service.users()
-            .messages()
-            .get(userId="me", id=msg_id, format="full")
-            .execute()
-        )
-
-        headers = msg_detail["payload"]["headers"]
-
-        subject = next(
-            (h["value"] for h in headers if h["name"] == "Subject"),
-            "(제목 없음)",
-        )
-        from_addr = next(
-            (h["value"] for h in headers if h["name"] == "From"),
-            "(발신자 없음)",
-        )
-        date_raw = next(
-            (h["value"] for h in headers if h["name"] == "Date"),
-            "(날짜 없음)",
-        )
-
-        body_text = get_plain_text_from_message(msg_detail)
+            headers = msg_detail["payload"]["headers"]
+
+            record = {
+                "subject": next(
+                    (h["value"] for h in headers if h["name"] == "Subject"),
+                    "(제목 없음)",
+                ),
+                "sender": next(
+                    (h["value"] for h in headers if h["name"] == "From"),
+                    "(발신자 없음)",
+                ),
+                "date": next(
+                    (h["value"] for h in headers if h["name"] == "Date"),
+                    "(날짜 없음)",
+                ),
+                # 수신거부 링크까지 뽑아야 해서 본문 압축(URL 축약) 없이 앞부분만 그대로 사용
+                "body": get_plain_text_from_message(msg_detail, max_chars=ANALYZER_BODY_CHARS),
+            }
+            cache.put(CACHE_USER_KEY, msg_id, record)
+
+        subject = record["subject"]
+        from_addr = record["sender"]
+        date_raw = record["date"]
+        body_text = record["body"]
 
         print(f"[{idx}/{len(msg_list)}] 분석 중: {subject[:60]}")
 
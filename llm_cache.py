@@ -0,0 +1,76 @@
+import os
+import re
+import json
+import hashlib
+import datetime as dt
+
+from sqlalchemy import delete, or_
+from sqlalchemy.future import select
+
+import models
+from batch_packer import MAX_ITEM_TOKENS
+from body_compaction import fit_body
+from database import AsyncSessionLocal
+
+# How long a cached extraction stays valid.
+LLM_CACHE_TTL_DAYS = int(os.getenv("LLM_CACHE_TTL_DAYS", "90"))
+_spaces = re.compile(r"\s+")
+
+
+def extraction_key(item, model_name, prompt_version):
+    # Same body compaction and item budget as prompt_line, so the key covers exactly what Gemini sees
+    content = "\n".join(
+        _spaces.sub(" ", text).strip()
+        for text in (item.get("subject") or "", item.get("sender") or "", fit_body(item.get("body"), MAX_ITEM_TOKENS))
+    )
+    return hashlib.sha256(f"{model_name}\n{prompt_version}\n{content}".encode("utf-8")).hexdigest()
+
+
+async def lookup_extractions(items, model_name, prompt_version):
+    """
+    Returns {item id: extraction} for items with a live cache entry. A cached "not a subscription"
+    answer maps to None, so `id in result` tells a hit from a miss.
+    """
+    if not items:
+        return {}
+    keys = {extraction_key(item, model_name, prompt_version): item["id"] for item in items}
+    now = dt.datetime.now(dt.timezone.utc)
+    async with AsyncSessionLocal() as session:
+        query = select(models.LLMExtractionCache).where(
+            models.LLMExtractionCache.cache_key.in_(list(keys)),
+            models.LLMExtractionCache.prompt_version == prompt_version,
+            models.LLMExtractionCache.expires_at > now,
+        )
+        rows = (await session.execute(query)).scalars().all()
+    return {keys[row.cache_key]: json.loads(row.result) if row.result else None for row in rows}
+
+
+async def store_extractions(items, analysis_map, model_name, prompt_version):
+    """Caches Gemini's answer for every item in a batch, including the ones it judged unrelated."""
+    if not items:
+        return
+    expires_at = dt.datetime.now(dt.timezone.utc) + dt.timedelta(days=LLM_CACHE_TTL_DAYS)
+    async with AsyncSessionLocal() as session:
+        for item in items:
+            analysis = analysis_map.get(item["id"])
+            await session.merge(models.LLMExtractionCache(
+                cache_key=extraction_key(item, model_name, prompt_version),
+                prompt_version=prompt_version,
+                result=json.dumps(analysis, ensure_ascii=False) if analysis is not None else None,
+                expires_at=expires_at,
+            ))
+        await session.commit()
+
+
+async def purge_stale_extractions(prompt_version):
+    """
+    Drops expired entries and every entry written under a different prompt version. Runs and commits
+    in its own session: store_extractions writes through separate sessions during the run, and an
+    uncommitted DELETE on the caller's session would lock them out until the run ends.
+    """
+    async with AsyncSessionLocal() as session:
+        await session.execute(delete(models.LLMExtractionCache).where(or_(
+            models.LLMExtractionCache.prompt_version != prompt_version,
+            models.LLMExtractionCache.expires_at <= dt.datetime.now(dt.timezone.utc),
+        )))
+        await session.commit()
@@ -0,0 +1,130 @@
+import re
+import html
+import base64
+import binascii
+
+# Enough of a body for body_compaction to find a price line below long headers; prompts see far less.
+BODY_CHAR_BUDGET = 12000
+# HTML carries far more markup than text, so decode more of it before converting.
+HTML_BUDGET_FACTOR = 8
+
+# A price with its currency, e.g. "₩17,000", "$9.99", "17,000원", "USD 12". Everything that looks
+# for amounts (triage, dedup, templates, body compaction) uses this one pattern so they agree.
+MONEY_PATTERN = re.compile(r"(?:₩|\$|€|£|¥|krw|usd)\s*\d[\d,]*(?:\.\d+)?|\d[\d,]*(?:\.\d+)?\s*(?:원|krw|usd)", re.IGNORECASE)
+
+_drop_blocks = re.compile(r"<(style|script|head)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_line_breaks = re.compile(r"<\s*(br|/p|/div|/tr|/li|/h[1-6])\b[^>]*>", re.IGNORECASE)
+_tags = re.compile(r"<[^>]+>")
+_spaces = re.compile(r"[ \t\r\f\v ]+")
+_newline_runs = re.compile(r"\s*\n\s*")
+
+
+def _decode(data, max_chars=None):
+    """Base64url-decodes a body part, only as much as is needed for `max_chars` characters."""
+    if max_chars is not None:
+        # Worst case 4 UTF-8 bytes per character; 4 base64 chars per 3 bytes
+        limit = (max_chars * 4 + 2) // 3 * 4
+        if len(data) > limit:
+            data = data[:limit]
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        return ""
+    return raw.decode("utf-8", errors="ignore")
+
+
+def html_to_text(markup):
+    """Fast, dependency-free HTML to text: drops <style>/<script>/<head>, tags and entity noise."""
+    text = _drop_blocks.sub(" ", markup)
+    text = _line_breaks.sub("\n", text)
+    text = _tags.sub(" ", text)
+    text = html.unescape(text)
+    text = _spaces.sub(" ", text)
+    return _newline_runs.sub("\n", text).strip()
+
+
+def get_plain_text_from_message(msg_detail, max_chars=BODY_CHAR_BUDGET):
+    """
+    Extracts the body text of a Gmail `format='full'` message.
+
+    Walks the MIME tree iteratively in document order and joins text/plain parts, stopping once
+    `max_chars` characters have been decoded (None = no limit). HTML-only mail falls back to the
+    first text/html part converted with html_to_text.
+    """
+    stack = [msg_detail.get("payload", {})]
+    text_parts = []
+    html_data = None
+    remaining = max_chars
+
+    while stack:
+        part = stack.pop()
+        sub_parts = part.get("parts")
+        if sub_parts:
+            stack.extend(reversed(sub_parts))
+            continue
+
+        data = part.get("body", {}).get("data")
+        if not data:
+            continue
+        mime_type = part.get("mimeType", "")
+        if mime_type == "text/plain":
+            text = _decode(data, remaining)
+            if remaining is not None:
+                text = text[:remaining]
+                remaining -= len(text)
+            text_parts.append(text)
+            if remaining is not None and remaining <= 0:
+                break
+        elif mime_type == "text/html" and html_data is None:
+            html_data = data
+
+    if text_parts:
+        return "\n".join(text_parts)
+    if html_data is not None:
+        html_budget = max_chars * HTML_BUDGET_FACTOR if max_chars is not None else None
+        text = html_to_text(_decode(html_data, html_budget))
+        return text[:max_chars] if max_chars is not None else text
+    return ""
+
+
+def _synthetic_message(n_plain, n_html, body_chars):
+    def encode(text):
+        return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+    plain = "결제 금액 ₩14,900 / Your subscription renews monthly.\n" * (body_chars // 50)
+    markup = (
+        "<html><head><style>p{color:red}</style></head><body>"
+        + "<p>Receipt &amp; invoice: $9.99 next billing 2025-01-01</p>" * (body_chars // 55)
+        + "<script>track()</script></body></html>"
+    )
+    parts = [{"mimeType": "text/plain", "body": {"data": encode(plain)}} for _ in range(n_plain)]
+    parts += [{"mimeType": "text/html", "body": {"data": encode(markup)}} for _ in range(n_html)]
+    attachment = {"mimeType": "application/pdf", "filename": "receipt.pdf", "body": {"attachmentId": "x", "size": 50000}}
+    return {
+        "payload": {
+            "mimeType": "multipart/mixed",
+            "parts": [{"mimeType": "multipart/alternative", "parts": parts}, attachment],
+        }
+    }
+
+
+def _benchmark(iterations=2000):
+    import time
+
+    cases = {
+        "plain 2KB": _synthetic_message(1, 1, 2_000),
+        "plain 200KB": _synthetic_message(1, 1, 200_000),
+        "html-only 50KB": _synthetic_message(0, 1, 50_000),
+        "3 plain parts 100KB": _synthetic_message(3, 0, 100_000),
+    }
+    for name, msg in cases.items():
+        for budget in (None, BODY_CHAR_BUDGET):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                get_plain_text_from_message(msg, max_chars=budget)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<22} budget={str(budget):<5} {iterations / elapsed:>10.0f} msgs/s")
+
+
+if __name__ == "__main__":
+    _benchmark()
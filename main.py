@@ -2,8 +2,6 @@ from fastapi import FastAPI, Request, HTTPException, Depends, status
 from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 import os
 import uvicorn
 from dotenv import load_dotenv
@@ -15,12 +13,14 @@ from datetime import datetime, timedelta
 import json
 
 # Database and schemas
-from database import engine, get_db
+from database import get_db
+from create_tables import create_tables
 import models
 import schemas
 
 # Analysis Logic
 from analysis_logic import run_analysis
+from gmail_service import forget_user
 
 # Load environment variables
 load_dotenv()
@@ -52,8 +52,7 @@ app = FastAPI()
 
 @app.on_event("startup")
 async def on_startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
+    await create_tables()
 
 app.add_middleware(
     CORSMiddleware,
@@ -275,6 +274,7 @@ async def google_auth_callback(request: Request, db: AsyncSession = Depends(get_
         "token": creds.token, "refresh_token": creds.refresh_token,
         "token_uri": creds.token_uri, "client_id": creds.client_id,
         "client_secret": creds.client_secret, "scopes": creds.scopes,
+        "expiry": creds.expiry,
     }
 
     if db_creds:
@@ -285,6 +285,8 @@ async def google_auth_callback(request: Request, db: AsyncSession = Depends(get_
         db.add(db_creds)
     
     await db.commit()
+    # New tokens: drop the cached Gmail service built from the old ones
+    forget_user(user.id)
     
     return RedirectResponse(f"{FRONTEND_URL}?google_linked=true")
 
@@ -293,14 +295,7 @@ async def analyze_user_gmail(current_user: models.User = Depends(get_current_use
     if not current_user.google_credentials:
         raise HTTPException(status_code=400, detail="Google account not linked.")
 
-    creds_data = current_user.google_credentials
-    credentials = Credentials(
-        token=creds_data.token, refresh_token=creds_data.refresh_token,
-        token_uri=creds_data.token_uri, client_id=creds_data.client_id,
-        client_secret=creds_data.client_secret, scopes=creds_data.scopes
-    )
-
-    analysis_results = await run_analysis(credentials, GEMINI_API_KEY, db, current_user.id)
+    analysis_results = await run_analysis(current_user.google_credentials, GEMINI_API_KEY, db, current_user.id)
     return analysis_results
 
 @app.get("/api/users/{user_id}/analysis")
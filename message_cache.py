@@ -0,0 +1,136 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Gmail messages are immutable, so the extracted fields can be cached indefinitely (subject to the size cap).
+MESSAGE_CACHE_PATH = os.getenv("MESSAGE_CACHE_PATH", "message_cache.sqlite3")
+MESSAGE_CACHE_MAX_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+FIELDS = ("subject", "sender", "date", "body")
+
+
+class MessageCache:
+    """
+    SQLite store of extracted message fields (subject, sender, date, body) keyed by
+    (user_key, message_id), with a byte cap enforced by least-recently-used eviction.
+    """
+
+    def __init__(self, path=MESSAGE_CACHE_PATH, max_bytes=MESSAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                user_key TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                subject TEXT, sender TEXT, date TEXT, body TEXT,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (user_key, message_id)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_messages_last_access ON messages (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+
+    def get_many(self, user_key, message_ids):
+        """Returns {message_id: {field: value}} for the ids that are cached, and marks them as recently used."""
+        user_key = str(user_key)
+        found = {}
+        ids = list(message_ids)
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT message_id, subject, sender, date, body FROM messages "
+                    f"WHERE user_key = ? AND message_id IN ({placeholders})",
+                    [user_key, *chunk],
+                ).fetchall()
+                for row in rows:
+                    found[row[0]] = dict(zip(FIELDS, row[1:]))
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE messages SET last_access = ? WHERE user_key = ? AND message_id = ?",
+                    [(now, user_key, msg_id) for msg_id in found],
+                )
+                self._conn.commit()
+        return found
+
+    def get(self, user_key, message_id):
+        return self.get_many(user_key, [message_id]).get(message_id)
+
+    def put_many(self, user_key, records):
+        """Stores {message_id: {field: value}} and evicts least-recently-used rows past the byte cap."""
+        if not records:
+            return
+        user_key = str(user_key)
+        now = time.time()
+        rows = []
+        for msg_id, record in records.items():
+            values = [record.get(field) or "" for field in FIELDS]
+            size = sum(len(v.encode("utf-8")) for v in values)
+            rows.append((user_key, msg_id, *values, size, now))
+
+        with self._lock:
+            for row in rows:
+                old = self._conn.execute(
+                    "SELECT size FROM messages WHERE user_key = ? AND message_id = ?", row[:2]
+                ).fetchone()
+                if old:
+                    self._total_bytes -= old[0]
+                self._total_bytes += row[6]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages (user_key, message_id, subject, sender, date, body, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._conn.commit()
+
+    def put(self, user_key, message_id, record):
+        self.put_many(user_key, {message_id: record})
+
+    def purge_user(self, user_key):
+        """Drops every cached message of one user."""
+        with self._lock:
+            freed = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM messages WHERE user_key = ?", (str(user_key),)
+            ).fetchone()[0]
+            self._conn.execute("DELETE FROM messages WHERE user_key = ?", (str(user_key),))
+            self._conn.commit()
+            self._total_bytes -= freed
+
+    def _evict(self):
+        # Evict down to 90% of the cap so eviction doesn't run on every insert once full
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > self.max_bytes:
+            victims = self._conn.execute(
+                "SELECT user_key, message_id, size FROM messages ORDER BY last_access LIMIT 200"
+            ).fetchall()
+            if not victims:
+                self._total_bytes = 0
+                return
+            for user_key, msg_id, size in victims:
+                self._conn.execute("DELETE FROM messages WHERE user_key = ? AND message_id = ?", (user_key, msg_id))
+                self._total_bytes -= size
+                if self._total_bytes <= target:
+                    return
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_message_cache():
+    """Process-wide cache instance, opened on first use."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = MessageCache()
+        return _default_cache
@@ -38,5 +38,20 @@ class GoogleCredentials(Base):
     client_id = Column(String)
     client_secret = Column(String)
     scopes = Column(JSON) # Using JSON type for scopes list
+    expiry = Column(DateTime, nullable=True) # Access token expiry (naive UTC, as google-auth uses)
+
+    # Incremental sync checkpoint: last seen Gmail historyId and ids already analyzed
+    history_id = Column(String, nullable=True)
+    processed_message_ids = Column(JSON, nullable=True)
     
     user = relationship("User", back_populates="google_credentials")
+
+class LLMExtractionCache(Base):
+    __tablename__ = "llm_extraction_cache"
+
+    # sha256 of model name + prompt version + normalized email content
+    cache_key = Column(String(64), primary_key=True)
+    prompt_version = Column(String, index=True, nullable=False)
+    result = Column(Text, nullable=True) # Extraction JSON, or NULL when the email is not a subscription
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), index=True, nullable=False)
@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import zlib
+import sqlite3
+import hashlib
+import threading
+from email.utils import parseaddr
+
+import numpy as np
+
+from dedup import normalize
+
+# Trained weights, the labeled examples collected from Gemini runs, and the gate threshold.
+CLASSIFIER_MODEL_PATH = os.getenv("CLASSIFIER_MODEL_PATH", "subscription_classifier.npz")
+CLASSIFIER_EXAMPLES_PATH = os.getenv("CLASSIFIER_EXAMPLES_PATH", "classifier_examples.sqlite3")
+# Emails scoring below this skip Gemini; keep it low, a missed subscription costs more than a call.
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", "0.05"))
+HASH_BITS = 18
+BODY_CHARS = 1500
+REPORT_THRESHOLDS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5)
+
+_word = re.compile(r"\w+")
+
+
+def features(item):
+    """Hashed word unigrams and bigrams of subject + body prefix, plus the sender domain."""
+    address = parseaddr(item.get("sender") or "")[1].lower()
+    tokens = _word.findall(normalize(f"{item.get('subject') or ''} {(item.get('body') or '')[:BODY_CHARS]}"))
+    grams = [f"w:{t}" for t in tokens] + [f"b:{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    grams.append(f"d:{address.rsplit('@', 1)[-1]}")
+    # crc32 is stable across processes, unlike hash(), so saved weights stay valid
+    mask = (1 << HASH_BITS) - 1
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) & mask for g in grams), dtype=np.int64, count=len(grams)))
+
+
+class SubscriptionClassifier:
+    """
+    Logistic regression over hashed binary n-gram features, each email's vector scaled to unit
+    length so long and short emails train at the same step size.
+    """
+
+    def __init__(self, weights=None, bias=0.0):
+        self.weights = np.zeros(1 << HASH_BITS) if weights is None else weights
+        self.bias = bias
+
+    def score(self, item):
+        """Probability that `item` is a subscription email."""
+        idx = features(item)
+        z = self.weights[idx].sum() / np.sqrt(len(idx)) + self.bias
+        return float(1 / (1 + np.exp(-z)))
+
+    def fit(self, items, labels, epochs=300, learning_rate=4.0, l2=1e-4):
+        """
+        Full-batch gradient descent on the sparse feature matrix. Positives are up-weighted by
+        the negative/positive ratio, since most emails are not subscriptions.
+        """
+        y = np.asarray(labels, dtype=np.float64)
+        feats = [features(item) for item in items]
+        rows = np.repeat(np.arange(len(feats)), [len(f) for f in feats])
+        cols = np.concatenate(feats) if feats else np.zeros(0, dtype=np.int64)
+        values = np.repeat([1 / np.sqrt(len(f)) for f in feats], [len(f) for f in feats])
+        positives = max(y.sum(), 1.0)
+        sample_weight = np.where(y == 1, (len(y) - positives) / positives, 1.0)
+        sample_weight /= sample_weight.sum()
+
+        for _ in range(epochs):
+            z = np.bincount(rows, weights=self.weights[cols] * values, minlength=len(y)) + self.bias
+            error = (1 / (1 + np.exp(-z)) - y) * sample_weight
+            grad = np.bincount(cols, weights=error[rows] * values, minlength=len(self.weights))
+            self.weights -= learning_rate * (grad + l2 * self.weights)
+            self.bias -= learning_rate * error.sum()
+        return self
+
+    def save(self, path=CLASSIFIER_MODEL_PATH):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, hash_bits=HASH_BITS)
+
+    @classmethod
+    def load(cls, path=CLASSIFIER_MODEL_PATH):
+        data = np.load(path)
+        if int(data["hash_bits"]) != HASH_BITS:
+            raise ValueError(f"{path} was trained with {int(data['hash_bits'])} hash bits, expected {HASH_BITS}")
+        return cls(data["weights"], float(data["bias"]))
+
+
+class ExampleStore:
+    """Gemini's verdict on every email it was shown, kept locally as training data."""
+
+    def __init__(self, path=CLASSIFIER_EXAMPLES_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS examples (key TEXT PRIMARY KEY, data TEXT NOT NULL, label INTEGER NOT NULL)")
+        self._conn.commit()
+
+    def add_many(self, items, labels):
+        rows = []
+        for item, label in zip(items, labels):
+            data = {"subject": item.get("subject") or "", "sender": item.get("sender") or "",
+                    "body": (item.get("body") or "")[:BODY_CHARS]}
+            encoded = json.dumps(data, ensure_ascii=False)
+            rows.append((hashlib.sha256(encoded.encode("utf-8")).hexdigest(), encoded, int(label)))
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO examples (key, data, label) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def all(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT data, label FROM examples").fetchall()
+        return [json.loads(data) for data, _ in rows], [label for _, label in rows]
+
+
+_default_store = None
+_default_classifier = None
+_default_lock = threading.Lock()
+
+
+def get_example_store():
+    """Process-wide example store, opened on first use."""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = ExampleStore()
+        return _default_store
+
+
+def get_classifier():
+    """The trained classifier, or None until `python subscription_classifier.py retrain` has written one."""
+    global _default_classifier
+    with _default_lock:
+        if _default_classifier is None and os.path.exists(CLASSIFIER_MODEL_PATH):
+            _default_classifier = SubscriptionClassifier.load()
+        return _default_classifier
+
+
+def report(classifier, items, labels, thresholds=REPORT_THRESHOLDS):
+    """Prints, per threshold, the recall of subscription emails and the share still sent to Gemini."""
+    scores = np.array([classifier.score(item) for item in items])
+    y = np.asarray(labels, dtype=bool)
+    print(f"{'threshold':>9} {'recall':>7} {'sent':>6} {'missed':>7}")
+    for threshold in thresholds:
+        sent = scores >= threshold
+        recall = (sent & y).sum() / max(y.sum(), 1)
+        print(f"{threshold:>9.2f} {recall:>7.1%} {sent.mean():>6.1%} {int((~sent & y).sum()):>7}")
+
+
+async def load_stored_positives():
+    """Subscription emails from saved GmailAnalysis rows, in the item shape features() reads."""
+    from sqlalchemy.future import select
+
+    import models
+    from database import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(select(models.GmailAnalysis.analysis_result))).scalars().all()
+    items = []
+    for raw in rows:
+        try:
+            record = json.loads(raw)
+        except (json.JSONDecodeError, TypeError):
+            continue
+        if record.get("subject") or record.get("body"):
+            items.append({"subject": record.get("subject"), "sender": record.get("from_name"), "body": record.get("body")})
+    return items
+
+
+def retrain(from_db=True, holdout=0.2):
+    """Trains on the collected examples (plus stored analyses), reports on a held-out split, then refits on everything and saves."""
+    import asyncio
+
+    items, labels = get_example_store().all()
+    if from_db:
+        positives = asyncio.run(load_stored_positives())
+        items += positives
+        labels += [1] * len(positives)
+    if not items or all(labels) or not any(labels):
+        print("Need both subscription and non-subscription examples; run a few analyses first.")
+        return None
+    print(f"Training on {len(items)} examples ({sum(labels)} subscriptions).")
+
+    # Split by content hash so the same email never lands on both sides
+    test = [int(hashlib.sha256(json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest(), 16) % 100 < holdout * 100
+            for item in items]
+    train_items = [item for item, t in zip(items, test) if not t]
+    train_labels = [label for label, t in zip(labels, test) if not t]
+    test_items = [item for item, t in zip(items, test) if t]
+    test_labels = [label for label, t in zip(labels, test) if t]
+    if test_items and any(test_labels) and train_items:
+        print(f"Held-out report ({len(test_items)} examples):")
+        report(SubscriptionClassifier().fit(train_items, train_labels), test_items, test_labels)
+
+    classifier = SubscriptionClassifier().fit(items, labels)
+    classifier.save()
+    print(f"Saved {CLASSIFIER_MODEL_PATH}; the gate uses CLASSIFIER_THRESHOLD={CLASSIFIER_THRESHOLD}.")
+    return classifier
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local pre-Gemini subscription classifier")
+    sub = parser.add_subparsers(dest="command", required=True)
+    retrain_cmd = sub.add_parser("retrain", help="train on collected examples and stored analyses")
+    retrain_cmd.add_argument("--no-db", action="store_true", help="skip positives from saved GmailAnalysis rows")
+    sub.add_parser("report", help="recall / Gemini-share trade-off of the saved model on the collected examples")
+    args = parser.parse_args()
+
+    if args.command == "retrain":
+        retrain(from_db=not args.no_db)
+    else:
+        classifier = get_classifier()
+        if classifier is None:
+            print(f"No model at {CLASSIFIER_MODEL_PATH}; run retrain first.")
+        else:
+            report(classifier, *get_example_store().all())
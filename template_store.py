@@ -0,0 +1,147 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from email.utils import parseaddr
+
+from determine3 import parse_amount
+from mail_text import MONEY_PATTERN
+
+# Where learned sender templates live, and how sure a template must be before Gemini is skipped.
+TEMPLATE_STORE_PATH = os.getenv("TEMPLATE_STORE_PATH", "sender_templates.sqlite3")
+TEMPLATE_MIN_CONFIDENCE = float(os.getenv("TEMPLATE_MIN_CONFIDENCE", "0.75"))
+# Words kept in front of the price as its locator, and how far past the locator the price may sit.
+ANCHOR_WORDS = 3
+PRICE_WINDOW = 40
+
+CONSTANT_FIELDS = ("service_name", "plan_name", "currency", "billing_cycle")
+
+_digit = re.compile(r"\d")
+_spaces = re.compile(r"\s+")
+
+
+def _mask(text):
+    # Same length as the input, so offsets found in the masked text are valid in the original
+    return _digit.sub("0", text.lower())
+
+
+def template_key(item):
+    """Sender domain plus the subject with digits masked, e.g. 'netflix.com|your receipt for 0000.00'."""
+    address = parseaddr(item.get("sender") or "")[1].lower()
+    domain = address.rsplit("@", 1)[-1]
+    subject = _spaces.sub(" ", _digit.sub("0", (item.get("subject") or "").lower())).strip()
+    return f"{domain}|{subject}"
+
+
+def _price_anchor(body, price):
+    """Finds the money token in `body` matching Gemini's price and returns the words just before it."""
+    value = parse_amount(price)
+    if value is None:
+        return None
+    masked = _mask(body)
+    for m in MONEY_PATTERN.finditer(body):
+        if parse_amount(m.group(0)) == value:
+            words = masked[max(0, m.start() - 80):m.start()].split()
+            if words:
+                return " ".join(words[-ANCHOR_WORDS:])
+    return None
+
+
+class TemplateStore:
+    """
+    Learns, per user and sender template, the constant fields Gemini extracted and a text anchor
+    that precedes the price, then extracts that user's later matching emails locally. Templates
+    are never shared between users: the same receipt carries a different plan for each of them.
+
+    Confidence is n / (n + 1), where n is how many consecutive Gemini results agreed with the
+    template, so the default 0.75 threshold needs three agreeing observations.
+    """
+
+    def __init__(self, path=TEMPLATE_STORE_PATH, min_confidence=TEMPLATE_MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS templates "
+            "(user_id INTEGER NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (user_id, key))"
+        )
+        self._conn.commit()
+        self._templates = {
+            (user_id, key): json.loads(data)
+            for user_id, key, data in self._conn.execute("SELECT user_id, key, data FROM templates")
+        }
+
+    def learn_many(self, user_id, extractions):
+        """
+        Updates the user's templates from (item, Gemini extraction) pairs, in one SQLite
+        transaction. Blocking; call it through run_blocking.
+        """
+        rows = []
+        with self._lock:
+            for item, analysis in extractions:
+                key = (user_id, template_key(item))
+                constants = {field: analysis.get(field) for field in CONSTANT_FIELDS}
+                anchor = _price_anchor(item.get("body") or "", analysis.get("price")) if analysis.get("price") else None
+
+                template = self._templates.get(key)
+                if analysis.get("price") and anchor is None:
+                    # Gemini saw a price we can't locate: this template can't be extracted locally
+                    template = {"constants": constants, "anchor": None, "observations": 0}
+                elif template and template["constants"] == constants and template["anchor"] == anchor:
+                    template["observations"] += 1
+                else:
+                    template = {"constants": constants, "anchor": anchor, "observations": 1}
+                self._templates[key] = template
+                rows.append((user_id, key[1], json.dumps(template, ensure_ascii=False)))
+            if rows:
+                self._conn.executemany("INSERT OR REPLACE INTO templates (user_id, key, data) VALUES (?, ?, ?)", rows)
+                self._conn.commit()
+
+    def extract(self, user_id, item):
+        """
+        Returns the extracted fields for an email matching one of the user's confident templates,
+        or None when there is no template, it is not confident enough, or its price anchor is not
+        in the body.
+        """
+        template = self._templates.get((user_id, template_key(item)))
+        if not template:
+            return None
+        n = template["observations"]
+        if n / (n + 1) < self.min_confidence:
+            return None
+
+        price = None
+        if template["anchor"]:
+            body = item.get("body") or ""
+            anchor = re.compile(r"\s+".join(re.escape(word) for word in template["anchor"].split()))
+            found = anchor.search(_mask(body))
+            if not found:
+                return None
+            start = found.end()
+            m = MONEY_PATTERN.search(body[start:start + PRICE_WINDOW])
+            if not m:
+                return None
+            price = m.group(0).strip()
+
+        return {
+            "is_subscription": True,
+            **template["constants"],
+            "price": price,
+            "start_date": None,
+            "next_billing_date": None,
+            "extracted_by": "template",
+        }
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def get_template_store():
+    """Process-wide template store, opened on first use."""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = TemplateStore()
+        return _default_store
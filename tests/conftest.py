@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+# Configuration is read at import time, so every database and local store points at a scratch
+# directory before any test imports the app (load_dotenv never overrides these).
+_scratch = tempfile.mkdtemp(prefix="subscription-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(_scratch, 'app.db')}",
+    "GOOGLE_API_KEY": "test-key",
+    "GEMINI_API_KEYS": "",
+    # The fake model answers instantly; the real per-minute quota would only slow the tests down
+    "GEMINI_RPM": "100000",
+    "GOOGLE_CREDENTIALS_JSON": '{"web": {}}',
+    "MESSAGE_CACHE_PATH": os.path.join(_scratch, "message_cache.sqlite3"),
+    "TEMPLATE_STORE_PATH": os.path.join(_scratch, "sender_templates.sqlite3"),
+    "CLASSIFIER_MODEL_PATH": os.path.join(_scratch, "subscription_classifier.npz"),
+    "CLASSIFIER_EXAMPLES_PATH": os.path.join(_scratch, "classifier_examples.sqlite3"),
+    "BULK_JOB_DIR": os.path.join(_scratch, "bulk_jobs"),
+})
@@ -0,0 +1,197 @@
+"""
+Stand-ins for Gmail and Gemini that let the real analysis pipeline run in tests. Both answer from
+threads of the I/O pool, like the real clients, so every fake call sleeps for its round trip.
+"""
+import re
+import json
+import time
+import base64
+import itertools
+import threading
+import datetime as dt
+from email.parser import Parser
+from email.utils import format_datetime
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import httplib2
+from googleapiclient.discovery import build
+
+import analysis_logic
+import bulk_analysis
+from gemini_limiter import estimate_tokens
+from gemini_pool import GeminiClientPool
+from gemini_prompts import BATCH_PROMPT, COMPACT_BATCH_PROMPT, TRIAGE_PROMPT
+
+_request_line = re.compile(r"^(GET|POST) (\S+)")
+# Message ids are unique across every fake mailbox, so the process-wide caches never mix tests
+_message_ids = itertools.count()
+
+
+class FakeGmail:
+    """
+    A mailbox behind an httplib2-compatible request(): getProfile, messages.list, history.list and
+    batched messages.get. deliver() adds a message and bumps the history id; a history list that
+    starts before `history_floor` answers 404, like an expired checkpoint. `failures` maps a
+    message id to the statuses its gets answer with before 200; delete() makes a message 404.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = {}
+        self.history = []
+        self.history_id = 1000
+        self.history_floor = 0
+        self.failures = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def deliver(self, subject, sender, body, days_ago=1):
+        msg_id = f"m{next(_message_ids):06d}"
+        sent = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=days_ago)
+        headers = [{"name": "Subject", "value": subject}, {"name": "From", "value": sender},
+                   {"name": "Date", "value": format_datetime(sent)}]
+        data = base64.urlsafe_b64encode(body.encode("utf-8")).decode("ascii")
+        with self._lock:
+            self.history_id += 1
+            self.messages[msg_id] = {
+                "id": msg_id, "threadId": msg_id, "labelIds": ["INBOX"], "internalDate": str(int(sent.timestamp() * 1000)),
+                "payload": {"mimeType": "text/plain", "headers": headers, "body": {"size": len(body), "data": data}},
+            }
+            self.history.append((self.history_id, msg_id))
+        return msg_id
+
+    def delete(self, msg_id):
+        with self._lock:
+            self.messages.pop(msg_id, None)
+
+    def service(self):
+        return build("gmail", "v1", http=self, static_discovery=True)
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        time.sleep(self.latency)
+        if urlsplit(uri).path == "/batch":
+            return self._batch(body, headers)
+        status, payload = self._answer(method, uri)
+        return httplib2.Response({"status": status, "content-type": "application/json"}), json.dumps(payload).encode("utf-8")
+
+    def _batch(self, body, headers):
+        boundary = "batch_response_boundary"
+        parts = []
+        message = Parser().parsestr(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        for part in message.get_payload():
+            method, path = _request_line.match(part.get_payload()).groups()
+            status, payload = self._answer(method, path)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:]}\r\n\r\n"
+                f"HTTP/1.1 {status} Fake\r\nContent-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n"
+            )
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        return httplib2.Response({"status": 200, "content-type": f"multipart/mixed; boundary={boundary}"}), content.encode("utf-8")
+
+    def _answer(self, method, uri):
+        url = urlsplit(uri)
+        path = url.path.removeprefix("/gmail/v1/users/me/")
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        with self._lock:
+            self.requests.append(path)
+            if path == "profile":
+                return 200, {"emailAddress": "me@example.com", "historyId": str(self.history_id)}
+            if path == "messages":
+                return 200, self._list(params)
+            if path == "history":
+                start = int(params["startHistoryId"])
+                if start < self.history_floor:
+                    return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+                added = [{"id": str(history_id), "messagesAdded": [{"message": {"id": msg_id, "labelIds": ["INBOX"]}}]}
+                         for history_id, msg_id in self.history if history_id > start]
+                return 200, {"history": added, "historyId": str(self.history_id)}
+            msg_id = path.removeprefix("messages/")
+            statuses = self.failures.get(msg_id)
+            status = statuses.pop(0) if statuses else 200
+            if status == 200 and msg_id not in self.messages:
+                status = 404
+            if status != 200:
+                return status, {"error": {"code": status, "message": "fake"}}
+            message = self.messages[msg_id]
+            if params.get("format") == "metadata":
+                return 200, {key: message[key] for key in ("id", "threadId", "labelIds")} | {"payload": {"headers": message["payload"]["headers"]}}
+            return 200, message
+
+    def _list(self, params):
+        ids = sorted(self.messages, reverse=True)
+        start = int(params.get("pageToken", 0))
+        end = start + int(params.get("maxResults", 100))
+        page = {"messages": [{"id": msg_id, "threadId": msg_id} for msg_id in ids[start:end]], "resultSizeEstimate": len(ids)}
+        if end < len(ids):
+            page["nextPageToken"] = str(end)
+        return page
+
+
+class FakeGemini:
+    """
+    Answers the triage and extraction prompts the way the real model would for clear-cut mail: an
+    email is a subscription when its subject says "receipt", and the service is the sender's name.
+    A batch holding one of the `garbled` subjects gets an unreadable answer.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.garbled = set()
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt):
+        time.sleep(self.latency)
+        instructions, _, listing = prompt.partition("\n\n### Email List\n")
+        emails = [json.loads(line) for line in listing.splitlines()]
+        hits = [email for email in emails if "receipt" in email["subject"].lower()]
+        with self._lock:
+            self.prompts.append(instructions)
+        if instructions == TRIAGE_PROMPT:
+            answer = [email["id"] for email in hits]
+        elif instructions == COMPACT_BATCH_PROMPT:
+            answer = [[email["id"], _service(email), None, "9900", "KRW", "m", None, None] for email in hits]
+        else:
+            assert instructions == BATCH_PROMPT
+            answer = [{"id": email["id"], "is_subscription": True, "service_name": _service(email), "plan_name": None,
+                       "price": "9900", "currency": "KRW", "billing_cycle": "monthly", "start_date": None,
+                       "next_billing_date": None} for email in hits]
+        text = json.dumps(answer, ensure_ascii=False)
+        if any(email["subject"] in self.garbled for email in emails):
+            text = "Sorry, something went wrong"
+        usage = SimpleNamespace(prompt_token_count=estimate_tokens(prompt), candidates_token_count=estimate_tokens(text))
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+
+def _service(email):
+    return email["sender"].split(" <")[0]
+
+
+async def linked_user(email="me@example.com"):
+    """Recreates the app's tables and adds a user with linked Google credentials; returns the user's id."""
+    import models
+    from database import AsyncSessionLocal, engine
+
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.drop_all)
+        await conn.run_sync(models.Base.metadata.create_all)
+    async with AsyncSessionLocal() as db:
+        user = models.User(email=email, name="Me")
+        db.add(user)
+        await db.flush()
+        user_id = user.id
+        db.add(models.GoogleCredentials(user_id=user_id, token="token"))
+        await db.commit()
+    return user_id
+
+
+def install(monkeypatch, gmail, gemini):
+    """Points run_analysis and the bulk job at the fake mailbox and every Gemini model at the fake model."""
+    def get_gmail_service(user_id, db_creds):
+        return gmail.service(), SimpleNamespace(token=db_creds.token, expiry=db_creds.expiry)
+
+    monkeypatch.setattr(analysis_logic, "get_gmail_service", get_gmail_service)
+    monkeypatch.setattr(bulk_analysis, "get_gmail_service", get_gmail_service)
+    monkeypatch.setattr(GeminiClientPool, "model", lambda pool, api_key, model_name, json_mode=False: gemini)
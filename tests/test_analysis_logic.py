@@ -0,0 +1,207 @@
+import random
+import asyncio
+import datetime as dt
+
+import pytest
+from sqlalchemy import select
+
+import fakes
+import gmail_fetch
+import models
+from analysis_logic import load_processed_ids, prune_processed_ids, recover_batch, run_analysis
+from database import AsyncSessionLocal, engine
+from fakes import FakeGemini, FakeGmail
+from gmail_quota import GmailQuotaLimiter
+
+
+def items(*ids):
+    return [{"id": _id} for _id in ids]
+
+
+class FakeAnalyzer:
+    """Answers every email as a subscription, except the ids `drop(chunk)` says were lost."""
+
+    def __init__(self, drop):
+        self.drop = drop
+        self.calls = []
+
+    async def __call__(self, chunk):
+        ids = [item["id"] for item in chunk]
+        self.calls.append(ids)
+        missing = set(self.drop(ids))
+        return {_id: {"id": _id, "is_subscription": True} for _id in ids if _id not in missing}, missing
+
+
+def recover(analyze, chunk):
+    recovery = {"salvaged": 0, "retried": 0, "splits": 0, "lost": 0}
+    lost_ids = set()
+    result = asyncio.run(recover_batch(analyze, chunk, recovery, lost_ids))
+    return result, recovery, lost_ids
+
+
+def test_salvaged_response_resends_only_the_rest():
+    analyze = FakeAnalyzer(lambda ids: {3, 4} if len(ids) == 4 else set())
+
+    result, recovery, lost_ids = recover(analyze, items(1, 2, 3, 4))
+
+    assert analyze.calls == [[1, 2, 3, 4], [3, 4]]
+    assert set(result) == {1, 2, 3, 4}
+    assert recovery == {"salvaged": 2, "retried": 2, "splits": 0, "lost": 0}
+    assert lost_ids == set()
+
+
+def test_unusable_batches_are_split_down_to_the_poisoned_email():
+    # Any batch holding email 3 comes back with nothing usable
+    analyze = FakeAnalyzer(lambda ids: set(ids) if 3 in ids else set())
+
+    result, recovery, lost_ids = recover(analyze, items(1, 2, 3, 4))
+
+    assert analyze.calls == [[1, 2, 3, 4], [1, 2], [3, 4], [3], [4]]
+    assert set(result) == {1, 2, 4}
+    assert recovery == {"salvaged": 0, "retried": 6, "splits": 2, "lost": 1}
+    assert lost_ids == {3}
+
+
+def test_complete_answer_is_not_retried():
+    analyze = FakeAnalyzer(lambda ids: set())
+
+    result, recovery, lost_ids = recover(analyze, items(1, 2))
+
+    assert analyze.calls == [[1, 2]]
+    assert recovery == {"salvaged": 0, "retried": 0, "splits": 0, "lost": 0}
+
+
+def test_legacy_processed_id_lists_are_dated_today():
+    today = dt.date.today().isoformat()
+
+    assert load_processed_ids(None) == {}
+    assert load_processed_ids(["a", "b"]) == {"a": today, "b": today}
+    stored = {"a": "2024-01-02"}
+    loaded = load_processed_ids(stored)
+    assert loaded == stored and loaded is not stored
+
+
+def test_processed_ids_older_than_the_horizon_are_pruned():
+    today = dt.date.today()
+    processed = {
+        "new": today.isoformat(),
+        "edge": (today - dt.timedelta(days=30)).isoformat(),
+        "old": (today - dt.timedelta(days=31)).isoformat(),
+    }
+
+    assert prune_processed_ids(processed, horizon_days=30) == {"new": processed["new"], "edge": processed["edge"]}
+
+
+@pytest.fixture
+def mailbox(monkeypatch):
+    """A fake mailbox and model wired into run_analysis, with Gmail retries that never sleep."""
+    monkeypatch.setattr(gmail_fetch, "limiter", GmailQuotaLimiter(user_rate=1e6, project_rate=1e6))
+    monkeypatch.setattr(gmail_fetch, "GMAIL_MAX_RETRIES", 0)
+    gmail, gemini = FakeGmail(), FakeGemini()
+    fakes.install(monkeypatch, gmail, gemini)
+    return gmail, gemini
+
+
+def receipt(gmail, service):
+    # Distinct bodies, so no email stands in for another as a near-duplicate
+    rng = random.Random(service)
+    body = " ".join(rng.choice("plan paid card total renewal invoice account monthly".split()) + str(rng.randrange(1000)) for _ in range(40))
+    return gmail.deliver(f"{service} receipt", f"{service} <billing@{service.lower()}.com>", body)
+
+
+def analyze(user_id):
+    """One run_analysis for the user; returns their (history id checkpoint, processed ids) afterwards."""
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            creds = (await db.execute(select(models.GoogleCredentials).where(models.GoogleCredentials.user_id == user_id))).scalar_one()
+            await run_analysis(creds, "test-key", db, user_id)
+        async with AsyncSessionLocal() as db:
+            creds = (await db.execute(select(models.GoogleCredentials).where(models.GoogleCredentials.user_id == user_id))).scalar_one()
+            checkpoint = creds.history_id, load_processed_ids(creds.processed_message_ids)
+        await engine.dispose()
+        return checkpoint
+
+    return asyncio.run(scenario())
+
+
+def new_user():
+    async def scenario():
+        user_id = await fakes.linked_user()
+        await engine.dispose()
+        return user_id
+
+    return asyncio.run(scenario())
+
+
+def test_incremental_sync_lists_only_history(mailbox):
+    gmail, gemini = mailbox
+    user_id = new_user()
+    first = [receipt(gmail, f"Alpha{i}") for i in range(3)]
+
+    history_id, processed = analyze(user_id)
+    assert history_id == str(gmail.history_id)
+    assert set(processed) == set(first)
+
+    added = receipt(gmail, "Beta")
+    gmail.requests.clear()
+    history_id, processed = analyze(user_id)
+
+    assert "history" in gmail.requests and "messages" not in gmail.requests
+    assert [path for path in gmail.requests if path.startswith("messages/")] == [f"messages/{added}"] * 2
+    assert history_id == str(gmail.history_id)
+    assert set(processed) == set(first) | {added}
+
+
+def test_expired_history_falls_back_to_a_full_resync(mailbox):
+    gmail, gemini = mailbox
+    user_id = new_user()
+    first = receipt(gmail, "Gamma")
+    analyze(user_id)
+
+    added = receipt(gmail, "Delta")
+    gmail.history_floor = gmail.history_id + 1
+    gmail.requests.clear()
+    history_id, processed = analyze(user_id)
+
+    assert "history" in gmail.requests and "messages" in gmail.requests
+    assert history_id == str(gmail.history_id)
+    assert set(processed) == {first, added}
+
+
+def test_retryable_fetch_errors_hold_the_checkpoint(mailbox):
+    gmail, gemini = mailbox
+    user_id = new_user()
+    first = receipt(gmail, "Epsilon")
+    checkpoint, _ = analyze(user_id)
+
+    failing = receipt(gmail, "Zeta")
+    gone = receipt(gmail, "Eta")
+    gmail.delete(gone)
+    gmail.failures[failing] = [503]
+    history_id, processed = analyze(user_id)
+
+    # The deleted message counts as processed; the one that failed transiently is listed again next time
+    assert history_id == checkpoint
+    assert set(processed) == {first, gone}
+
+    history_id, processed = analyze(user_id)
+    assert history_id == str(gmail.history_id)
+    assert set(processed) == {first, gone, failing}
+
+
+def test_lost_answers_hold_the_checkpoint(mailbox):
+    gmail, gemini = mailbox
+    user_id = new_user()
+    kept = receipt(gmail, "Theta")
+    lost = receipt(gmail, "Iota")
+    gemini.garbled.add("Iota receipt")
+
+    history_id, processed = analyze(user_id)
+
+    assert history_id is None
+    assert set(processed) == {kept}
+
+    gemini.garbled.clear()
+    history_id, processed = analyze(user_id)
+    assert history_id == str(gmail.history_id)
+    assert set(processed) == {kept, lost}
@@ -0,0 +1,110 @@
+import time
+import random
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import blocking_io
+import fakes
+from blocking_io import run_blocking, run_gemini
+from database import engine
+from fakes import FakeGemini, FakeGmail
+
+
+def test_cancelled_call_keeps_its_slot_until_the_thread_returns():
+    release = threading.Event()
+    started = []
+
+    def blocker():
+        release.wait(5)
+
+    def probe():
+        started.append(time.monotonic())
+
+    async def scenario():
+        user_id = "cancelled-calls"
+        calls = [asyncio.ensure_future(run_blocking(user_id, blocker)) for _ in range(blocking_io.PER_USER_INFLIGHT)]
+        await asyncio.sleep(0.05)
+        for call in calls:
+            call.cancel()
+        await asyncio.gather(*calls, return_exceptions=True)
+
+        # Every slot still belongs to a running thread, so the next call has to wait for one
+        waiting = asyncio.ensure_future(run_blocking(user_id, probe))
+        await asyncio.sleep(0.2)
+        assert not started
+        released_at = time.monotonic()
+        release.set()
+        await asyncio.wait_for(waiting, 5)
+        assert started and started[0] >= released_at
+
+    asyncio.run(scenario())
+
+
+def test_gemini_calls_leave_the_io_slots_free():
+    release = threading.Event()
+
+    async def scenario():
+        user_id = "busy-gemini"
+        gemini = [asyncio.ensure_future(run_gemini(user_id, release.wait, 5)) for _ in range(blocking_io.PER_USER_GEMINI_INFLIGHT)]
+        await asyncio.sleep(0.05)
+        # Every Gemini slot is taken, yet a Gmail-side call of the same user runs right away
+        assert await asyncio.wait_for(run_blocking(user_id, lambda: "fetched"), 1) == "fetched"
+        release.set()
+        await asyncio.gather(*gemini)
+
+    asyncio.run(scenario())
+
+
+def mailbox(size=200, body_chars=12_000, latency=0.0):
+    """Receipts and ordinary mail with long bodies, so parsing and dedup have real work to do."""
+    rng = random.Random(size)
+    words = "the your order plan account monthly update team please view details week news price".split()
+    gmail = FakeGmail(latency=latency)
+    for i in range(size):
+        body = " ".join(rng.choice(words) for _ in range(body_chars // 6))[:body_chars]
+        if i % 4 == 0:
+            gmail.deliver(f"Your receipt #{i}", f"Service{i % 7} <billing@service{i % 7}.com>", f"Paid 9,900원. {body}")
+        else:
+            gmail.deliver(f"Weekly order news {i}", f"Shop{i % 5} <news@shop{i % 5}.com>", body)
+    return gmail
+
+
+def test_me_latency_stays_flat_during_analysis(monkeypatch):
+    import main
+
+    gmail = mailbox(latency=0.05)
+    gemini = FakeGemini(latency=0.3)
+    fakes.install(monkeypatch, gmail, gemini)
+
+    async def scenario():
+        await fakes.linked_user("me@example.com")
+        headers = {"Authorization": f"Bearer {main.create_access_token({'sub': 'me@example.com'})}"}
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+            async def me_latency():
+                started = time.monotonic()
+                resp = await client.get("/api/me", headers=headers)
+                assert resp.status_code == 200
+                return time.monotonic() - started
+
+            await me_latency()
+            idle = min([await me_latency() for _ in range(5)])
+
+            # The real run_analysis: paged listing, batched fetches, parsing, dedup and Gemini batches
+            analysis = asyncio.ensure_future(client.post("/api/analyze/gmail", headers=headers))
+            busy = []
+            while not analysis.done():
+                busy.append(await me_latency())
+                await asyncio.sleep(0.02)
+            resp = await analysis
+        await engine.dispose()
+
+        assert resp.status_code == 200
+        assert {row["service_name"] for row in resp.json()} == {f"Service{i}" for i in range(7)}
+        assert gemini.prompts and len(busy) > 10
+        assert max(busy) < idle + 0.25, f"/api/me took {max(busy):.3f}s during analysis vs {idle:.3f}s idle"
+
+    asyncio.run(scenario())
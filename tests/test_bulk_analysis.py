@@ -0,0 +1,98 @@
+import os
+import json
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+import fakes
+import bulk_analysis
+import gmail_fetch
+import models
+from analysis_logic import run_analysis
+from bulk_analysis import LocalBatchBackend, collect_user_batches, prepare_job, run_bulk
+from database import AsyncSessionLocal, engine
+from fakes import FakeGemini, FakeGmail
+from gemini_prompts import BATCH_PROMPT_VERSION, GEMINI_MODEL_NAME
+from gmail_quota import GmailQuotaLimiter
+from llm_cache import lookup_extractions
+
+
+@pytest.fixture
+def mailbox(monkeypatch):
+    monkeypatch.setattr(gmail_fetch, "limiter", GmailQuotaLimiter(user_rate=1e6, project_rate=1e6))
+    gmail, gemini = FakeGmail(), FakeGemini()
+    fakes.install(monkeypatch, gmail, gemini)
+    return gmail, gemini
+
+
+async def credentials(db, user_id):
+    return (await db.execute(select(models.GoogleCredentials).where(models.GoogleCredentials.user_id == user_id))).scalar_one()
+
+
+def test_batches_follow_the_incremental_sync(mailbox):
+    gmail, gemini = mailbox
+
+    async def scenario():
+        user_id = await fakes.linked_user()
+        gmail.deliver("Alpha receipt", "Alpha <billing@alpha.com>", "Paid 9,900 for the alpha plan this month")
+        async with AsyncSessionLocal() as db:
+            await run_analysis(await credentials(db, user_id), "test-key", db, user_id)
+
+        added = gmail.deliver("Beta receipt", "Beta <billing@beta.com>", "Your beta membership renewed for another year")
+        gmail.requests.clear()
+        async with AsyncSessionLocal() as db:
+            creds = await credentials(db, user_id)
+            checkpoint = creds.history_id
+            batches = await collect_user_batches(creds, user_id)
+            await db.commit()
+        async with AsyncSessionLocal() as db:
+            creds = await credentials(db, user_id)
+            after = creds.history_id, set(creds.processed_message_ids)
+        await engine.dispose()
+        return added, checkpoint, batches, after
+
+    added, checkpoint, batches, (history_id, processed) = asyncio.run(scenario())
+
+    # Only the message added since the last run, listed through history like run_analysis would
+    assert [[item["message_id"] for item in batch] for batch in batches] == [[added]]
+    assert "history" in gmail.requests and "messages" not in gmail.requests
+    # Collecting batches never moves the checkpoint
+    assert history_id == checkpoint and added not in processed
+
+
+def test_local_job_answers_are_cached_apart(mailbox, tmp_path, monkeypatch):
+    gmail, gemini = mailbox
+    monkeypatch.setattr(bulk_analysis, "BULK_JOB_DIR", str(tmp_path))
+    monkeypatch.setattr(bulk_analysis, "BULK_POLL_SECONDS", 0)
+    backend = LocalBatchBackend(str(tmp_path / "local"), lambda request: gemini.generate_content(request["contents"][0]["parts"][0]["text"]).text)
+
+    async def scenario():
+        user_id = await fakes.linked_user()
+        gmail.deliver("Gamma receipt", "Gamma <billing@gamma.com>", "Paid 9,900 for the gamma plan this month")
+        gmail.deliver("Delta order shipped", "Delta <orders@delta.com>", "Your delta order is on its way to you")
+        with pytest.raises(ValueError):
+            await run_bulk(backend, "test-key", reanalyze=True)
+
+        job_dir = await prepare_job(backend)
+        await run_bulk(backend, "test-key", job_dir=job_dir, reanalyze=False)
+        with open(os.path.join(job_dir, "job.json")) as f:
+            job = json.load(f)
+        with open(os.path.join(job_dir, "manifest.jsonl"), encoding="utf-8") as f:
+            items = [item for entry in map(json.loads, f) for item in entry["items"]]
+        local = await lookup_extractions(items, GEMINI_MODEL_NAME, job["prompt_version"])
+        real = await lookup_extractions(items, GEMINI_MODEL_NAME, BATCH_PROMPT_VERSION)
+        async with AsyncSessionLocal() as db:
+            history_id = (await credentials(db, user_id)).history_id
+        await engine.dispose()
+        return job, items, local, real, history_id
+
+    job, items, local, real, history_id = asyncio.run(scenario())
+
+    assert job["prompt_version"] == LocalBatchBackend.prompt_version != BATCH_PROMPT_VERSION
+    assert {item["subject"] for item in items} == {"Gamma receipt", "Delta order shipped"}
+    by_subject = {item["subject"]: local[item["id"]] for item in items}
+    assert by_subject["Gamma receipt"]["service_name"] == "Gamma"
+    assert by_subject["Delta order shipped"] is None
+    # The synchronous analysis never sees the stand-in's answers, and nothing moved the checkpoint
+    assert real == {} and history_id is None
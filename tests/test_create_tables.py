@@ -0,0 +1,43 @@
+import asyncio
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from create_tables import create_tables, migrate
+from database import engine
+
+
+def columns(conn, table_name):
+    return {column["name"] for column in inspect(conn).get_columns(table_name)}
+
+
+def test_missing_columns_are_added_to_an_old_table(tmp_path):
+    async def scenario():
+        old = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.db'}")
+        async with old.begin() as conn:
+            await conn.execute(text("CREATE TABLE google_credentials (id INTEGER PRIMARY KEY, user_id INTEGER, token VARCHAR)"))
+            await conn.execute(text("INSERT INTO google_credentials (user_id, token) VALUES (1, 'token')"))
+            # Runs on every startup, so a second pass must be a no-op
+            await conn.run_sync(migrate)
+            await conn.run_sync(migrate)
+            found = await conn.run_sync(columns, "google_credentials")
+            rows = (await conn.execute(text("SELECT token, history_id FROM google_credentials"))).all()
+        await old.dispose()
+        return found, rows
+
+    found, rows = asyncio.run(scenario())
+
+    assert {"expiry", "history_id", "processed_message_ids"} <= found
+    assert rows == [("token", None)]
+
+
+def test_create_tables_runs_on_every_startup():
+    async def scenario():
+        await create_tables()
+        await create_tables()
+        async with engine.connect() as conn:
+            found = await conn.run_sync(columns, "google_credentials")
+        await engine.dispose()
+        return found
+
+    assert {"expiry", "history_id", "processed_message_ids"} <= asyncio.run(scenario())
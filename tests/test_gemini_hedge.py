@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+import gemini_hedge
+from gemini_hedge import HEDGE_MIN_SAMPLES, HedgePolicy
+
+
+@pytest.fixture(autouse=True)
+def short_deadlines(monkeypatch):
+    monkeypatch.setattr(gemini_hedge, "HEDGE_MIN_SECONDS", 0.01)
+
+
+def policy(deadline=0.05):
+    hedger = HedgePolicy(enabled=True, max_rate=1.0, latencies={})
+    for _ in range(HEDGE_MIN_SAMPLES):
+        hedger.record("extract", deadline)
+    return hedger
+
+
+def test_slow_running_call_is_hedged():
+    hedger = policy()
+    calls = []
+
+    async def call(running):
+        calls.append(running)
+        running.set()
+        await asyncio.sleep(0.5 if len(calls) == 1 else 0.01)
+        return len(calls)
+
+    result = asyncio.run(hedger.run("extract", call))
+
+    assert hedger.hedges == 1 and hedger.hedge_wins == 1
+    assert result == 2
+
+
+def test_call_waiting_for_a_slot_is_not_hedged():
+    hedger = policy()
+    calls = []
+
+    async def call(running):
+        calls.append(running)
+        # Queued well past the deadline, then fast once it runs
+        await asyncio.sleep(0.3)
+        running.set()
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    assert asyncio.run(hedger.run("extract", call)) == "answer"
+    assert hedger.hedges == 0 and len(calls) == 1
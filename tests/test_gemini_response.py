@@ -0,0 +1,75 @@
+import pytest
+
+from gemini_prompts import decode_batch_response
+from gemini_response import coerce_id, expand_rows, parse_json_array
+
+ROW = '["{id}", "Netflix", "Premium", "17000", "KRW", "m", null, "2025-01-05"]'
+ITEMS = [{"id": 1}, {"id": 2}, {"id": 3}]
+
+
+def row(_id):
+    return ROW.replace('"{id}"', str(_id))
+
+
+@pytest.mark.parametrize("text, element_type, expected, complete", [
+    ('[{"id": 1}, {"id": 2}]', dict, [{"id": 1}, {"id": 2}], True),
+    ("[]", dict, [], True),
+    ('```json\n[{"id": 1}]\n```', dict, [{"id": 1}], True),
+    # Truncated: the complete elements are kept
+    ('[{"id": 1}, {"id": 2}, {"id": 3, "servi', dict, [{"id": 1}, {"id": 2}], False),
+    # A broken element in the middle costs only itself
+    ('[{"id": 1}, {"id": 2, oops}, {"id": 3}]', dict, [{"id": 1}, {"id": 3}], False),
+    ('[[1, "a"], [2, "b"', list, [[1, "a"]], False),
+    # Keyed objects where rows were asked for are lost answers, not an empty result
+    ('[{"id": 1}]', list, [], False),
+    ('[[1, "a"], {"id": 2}]', list, [[1, "a"]], False),
+    ('{"id": 1}', dict, [], False),
+    ("no json here", dict, [], False),
+])
+def test_parse_json_array(text, element_type, expected, complete):
+    assert parse_json_array(text, element_type=element_type) == (expected, complete)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (3, 3), ("3", 3), (" 3 ", 3), (3.0, 3), (3.5, None), ("x3", None), (None, None), (True, None),
+])
+def test_coerce_id(value, expected):
+    assert coerce_id(value) == expected
+
+
+def test_expand_rows_maps_codes_and_drops_bad_rows():
+    fields = ("id", "service_name", "billing_cycle")
+    rows = [[1, "Netflix", "m"], ["2", "Spotify", "y"], [3, "too", "long", "row"], [None, "x", "m"], []]
+
+    assert expand_rows(rows, fields) == {
+        1: {"id": 1, "is_subscription": True, "service_name": "Netflix", "billing_cycle": "monthly"},
+        2: {"id": 2, "is_subscription": True, "service_name": "Spotify", "billing_cycle": "yearly"},
+    }
+
+
+@pytest.mark.parametrize("text, compact, answered, missing", [
+    (f"[{row(1)}]", True, {1}, set()),
+    ("[]", True, set(), set()),
+    (f"```json\n[{row(2)}]\n```", True, {2}, set()),
+    # String ids are coerced
+    (f'[{row(chr(34) + "3" + chr(34))}]', True, {3}, set()),
+    # Truncated array: everything unanswered may have been lost
+    (f"[{row(1)}, {row(2)}", True, {1, 2}, {3}),
+    (f"[{row(1)}, [2, \"Spo", True, {1}, {2, 3}),
+    (f"[{row(1)}, [2, oops], {row(3)}]", True, {1, 3}, {2}),
+    # Well-formed, but with elements that had to be dropped
+    ('[[1, "Netflix"]]', True, set(), {1, 2, 3}),
+    (f'[{row(1)}, {{"id": 2, "service_name": "Spotify"}}]', True, {1}, {2, 3}),
+    (f"[{row(9)}]", True, set(), {1, 2, 3}),
+    (f"[{row(1)}, {row(9)}]", True, {1}, {2, 3}),
+    # Verbose objects
+    ('[{"id": "2", "is_subscription": true, "service_name": "Spotify"}]', False, {2}, set()),
+    ('[{"id": 1, "is_subscription": false}]', False, set(), set()),
+    ('[{"id": 7, "is_subscription": true}]', False, set(), {1, 2, 3}),
+    ('[{"id": 1, "is_subscription": true}, {"id": 2, "is_sub', False, {1}, {2, 3}),
+])
+def test_decode_batch_response(text, compact, answered, missing):
+    result, lost = decode_batch_response(text, ITEMS, compact)
+    assert set(result) == answered
+    assert lost == missing
+    assert all(result[_id]["id"] == _id for _id in result)
@@ -0,0 +1,124 @@
+import re
+import json
+from email.parser import Parser
+
+import httplib2
+import pytest
+from googleapiclient.discovery import build
+
+import gmail_fetch
+from fakes import FakeGmail
+from gmail_quota import GmailQuotaLimiter, is_not_found, is_retryable
+
+_message_path = re.compile(r"^GET /gmail/v1/users/me/messages/([^?\s/]+)")
+
+
+class FakeBatchEndpoint:
+    """
+    Stands in for Gmail's /batch endpoint behind an httplib2-compatible request(). Each call is one
+    round trip; `failures` maps a message id to the statuses it answers with on successive
+    requests, before it finally answers 200.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = {msg_id: list(statuses) for msg_id, statuses in (failures or {}).items()}
+        self.round_trips = []
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        assert uri == "https://gmail.googleapis.com/batch" and method == "POST"
+        boundary = "batch_response_boundary"
+        parts = []
+        message = Parser().parsestr(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        ids = []
+        for part in message.get_payload():
+            msg_id = _message_path.match(part.get_payload()).group(1)
+            ids.append(msg_id)
+            statuses = self.failures.get(msg_id)
+            status = statuses.pop(0) if statuses else 200
+            payload = {"id": msg_id} if status == 200 else {"error": {"code": status, "message": "fake"}}
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:]}\r\n\r\n"
+                f"HTTP/1.1 {status} Fake\r\nContent-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n"
+            )
+        self.round_trips.append(ids)
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        resp = httplib2.Response({"status": 200, "content-type": f"multipart/mixed; boundary={boundary}"})
+        return resp, content.encode("utf-8")
+
+
+@pytest.fixture(autouse=True)
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(gmail_fetch, "limiter", GmailQuotaLimiter(user_rate=1e6, project_rate=1e6))
+    monkeypatch.setattr(gmail_fetch.time, "sleep", lambda seconds: None)
+
+
+def gmail(endpoint):
+    return build("gmail", "v1", http=endpoint, static_discovery=True)
+
+
+def test_one_round_trip_per_batch():
+    endpoint = FakeBatchEndpoint()
+    ids = [f"m{i}" for i in range(120)]
+
+    details, errors = gmail_fetch.fetch_messages_batched(gmail(endpoint), ids, batch_size=50)
+
+    assert [len(trip) for trip in endpoint.round_trips] == [50, 50, 20]
+    assert set(details) == set(ids)
+    assert all(details[msg_id]["id"] == msg_id for msg_id in ids)
+    assert errors == {}
+
+
+def test_item_errors_do_not_fail_the_batch():
+    endpoint = FakeBatchEndpoint(failures={"m1": [404], "m3": [403]})
+    ids = [f"m{i}" for i in range(5)]
+
+    details, errors = gmail_fetch.fetch_messages_batched(gmail(endpoint), ids)
+
+    # Permanent errors are reported, not retried
+    assert len(endpoint.round_trips) == 1
+    assert set(details) == {"m0", "m2", "m4"}
+    assert set(errors) == {"m1", "m3"}
+    assert is_not_found(errors["m1"])
+    assert not is_retryable(errors["m3"])
+
+
+def test_retryable_items_are_rebatched():
+    endpoint = FakeBatchEndpoint(failures={"m2": [429, 503], "m7": [500]})
+    ids = [f"m{i}" for i in range(10)]
+
+    details, errors = gmail_fetch.fetch_messages_batched(gmail(endpoint), ids, batch_size=4)
+
+    assert endpoint.round_trips[:3] == [ids[0:4], ids[4:8], ids[8:10]]
+    # Only the failed items go out again, packed into one batch per attempt
+    assert endpoint.round_trips[3:] == [["m2", "m7"], ["m2"]]
+    assert set(details) == set(ids)
+    assert errors == {}
+
+
+def test_retryable_items_give_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(gmail_fetch, "GMAIL_MAX_RETRIES", 2)
+    endpoint = FakeBatchEndpoint(failures={"m1": [429] * 10})
+
+    details, errors = gmail_fetch.fetch_messages_batched(gmail(endpoint), ["m0", "m1"])
+
+    assert endpoint.round_trips == [["m0", "m1"], ["m1"], ["m1"]]
+    assert set(details) == {"m0"}
+    assert set(errors) == {"m1"} and is_retryable(errors["m1"])
+
+
+def test_history_lists_added_messages_since_the_checkpoint():
+    mailbox = FakeGmail()
+    mailbox.deliver("old", "a@example.com", "body")
+    checkpoint = mailbox.history_id
+    added = [mailbox.deliver(f"new {i}", "a@example.com", "body") for i in range(2)]
+
+    assert gmail_fetch.list_history_message_ids(mailbox.service(), checkpoint) == added
+
+
+def test_expired_history_returns_none():
+    mailbox = FakeGmail()
+    mailbox.deliver("old", "a@example.com", "body")
+    mailbox.history_floor = mailbox.history_id + 1
+
+    assert gmail_fetch.list_history_message_ids(mailbox.service(), mailbox.history_id) is None
@@ -0,0 +1,48 @@
+import os
+
+from mail_text import MONEY_PATTERN
+
+# Headers requested in the metadata pass, and a field mask so Gmail returns nothing else.
+TRIAGE_HEADERS = ["Subject", "From", "Date"]
+TRIAGE_FIELDS = "id,threadId,labelIds,payload/headers"
+
+# Messages scoring below this are not downloaded in full. Kept low on purpose: a missed
+# receipt costs more than an extra full download.
+TRIAGE_MIN_SCORE = int(os.getenv("TRIAGE_MIN_SCORE", "1"))
+
+SUBJECT_KEYWORDS = [
+    "결제", "영수증", "구독", "청구", "정기", "자동", "갱신", "멤버십", "요금", "이용권", "해지", "주문",
+    "receipt", "invoice", "subscription", "subscribe", "renewal", "renew", "billing", "payment",
+    "order", "membership", "plan", "trial", "charged", "purchase", "newsletter",
+]
+SENDER_KEYWORDS = [
+    "billing", "invoice", "receipt", "payment", "pay", "noreply", "no-reply", "subscription",
+    "apple", "google", "netflix", "spotify", "youtube", "paypal", "stripe", "coupang", "naver",
+    "kakao", "toss", "adobe", "microsoft", "amazon", "disney", "wavve", "tving", "watcha", "melon",
+]
+NEGATIVE_PREFIXES = ("(광고", "[광고")
+
+
+def headers_to_dict(headers):
+    return {h["name"].lower(): h["value"] for h in headers}
+
+
+def score_message(subject, sender):
+    """Cheap header/sender score: higher means more likely to be a subscription or payment email."""
+    subject_l = (subject or "").lower().strip()
+    sender_l = (sender or "").lower()
+
+    if subject_l.startswith(NEGATIVE_PREFIXES):
+        return 0
+
+    score = 0
+    score += 2 * sum(1 for kw in SUBJECT_KEYWORDS if kw in subject_l)
+    score += sum(1 for kw in SENDER_KEYWORDS if kw in sender_l)
+    if MONEY_PATTERN.search(subject_l):
+        score += 2
+    return score
+
+
+def is_candidate(msg_metadata, min_score=TRIAGE_MIN_SCORE):
+    headers = headers_to_dict(msg_metadata.get("payload", {}).get("headers", []))
+    return score_message(headers.get("subject", ""), headers.get("from", "")) >= min_score